@@ -151,6 +151,23 @@ else:
         },
     }
 
+# --- CACHE ---
+# Redis in production so every worker shares the same cached route data;
+# a per-process memory cache for local development.
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
 # --- CORS (Cross-Origin) ---
 # We will set this in the Railway dashboard
 CORS_ALLOWED_ORIGINS = [
@@ -204,5 +221,66 @@ COLLEGE_COORDS = {
     "latitude": 12.9003207224315, 
     "longitude": 77.49589092463299,
 }
+# Seats on a route's vehicle unless set otherwise on the route
 BUS_CAPACITY = 5
+# Vehicles the optimizer may use for new routes, as seats:count pairs,
+# e.g. "40:3,5:20" (three 40-seat buses and twenty 5-seat vans). A size
+# without a count ("5") has no limit. Vehicles already running a route
+# count against these numbers.
+VEHICLE_FLEET = {
+    int(seats): int(count[0]) if count else None
+    for seats, *count in (
+        entry.split(':') for entry in os.environ.get('VEHICLE_FLEET', str(BUS_CAPACITY)).split(',')
+    )
+}
+# The longest a planned route may take (seconds). Larger vehicles are
+# swapped for smaller ones until every new route fits, where the fleet allows.
+MAX_ROUTE_SECONDS = float(os.environ.get('MAX_ROUTE_SECONDS', 90 * 60))
+# What one more vehicle is worth in fleet driving time (seconds) when
+# comparing vehicle mixes: a mix with an extra vehicle must save more
+# driving than this to win.
+VEHICLE_COST_SECONDS = float(os.environ.get('VEHICLE_COST_SECONDS', 30 * 60))
+
+# --- TRAVEL TIME MODEL ---
+# 'ors' asks OpenRouteService for driving times, 'local' estimates them
+# from straight-line distance (no network needed, used as ORS fallback).
+TRAVEL_TIME_PROVIDER = os.environ.get('TRAVEL_TIME_PROVIDER', 'ors')
+# Roads are longer than a straight line by roughly this factor
+ROAD_DETOUR_FACTOR = float(os.environ.get('ROAD_DETOUR_FACTOR', 1.4))
+# Average bus speed per stretch of a trip: (length of stretch in km, km/h).
+# Short hops crawl through junctions, longer trips reach the main roads.
+# The last stretch (None) covers the rest of the trip.
+AVERAGE_SPEED_MODEL = [
+    (1, 15),
+    (4, 25),
+    (None, 35),
+]
+# ORS driving times are kept in the TravelTimeCache table.
+# Coordinates are rounded to this many decimal places (4 ~ 11 meters),
+# entries older than the TTL are fetched again, and the least recently
+# used ones are dropped once the table grows past MAX_ENTRIES.
+TRAVEL_TIME_CACHE_PRECISION = 4
+TRAVEL_TIME_CACHE_TTL_DAYS = 30
+TRAVEL_TIME_CACHE_MAX_ENTRIES = 200000
+# When a student joins an existing route they are slotted into the current
+# pickup order. The route is only fully re-sorted if that order is more than
+# this fraction slower (0.15 = 15%) than driving farthest stop first.
+ROUTE_REOPTIMIZE_TOLERANCE = 0.15
+# Time limit (seconds) for polishing one route's pickup order with 2-opt/Or-opt
+ROUTE_SEARCH_SECONDS = float(os.environ.get('ROUTE_SEARCH_SECONDS', 0.5))
+# Largest ORS matrix request (sources x destinations) we send in one call
+ORS_MATRIX_MAX_ELEMENTS = 3500
+
+# --- LIVE BUS LOCATIONS ---
+# Pings are kept in the cache and written to DriverProfile in batches
+# this often (seconds)
+LOCATION_FLUSH_SECONDS = int(os.environ.get('LOCATION_FLUSH_SECONDS', 30))
+# A new position is only broadcast to the route's riders if the bus moved
+# at least this far (meters) and the last broadcast is this many seconds
+# old. A parked bus is still re-sent every MAX seconds, and a geofence
+# notification always goes out together with its position.
+BROADCAST_MIN_DISTANCE_METERS = float(os.environ.get('BROADCAST_MIN_DISTANCE_METERS', 15))
+BROADCAST_MIN_SECONDS = float(os.environ.get('BROADCAST_MIN_SECONDS', 2))
+BROADCAST_MAX_SECONDS = float(os.environ.get('BROADCAST_MAX_SECONDS', 30))
+
 LOGOUT_REDIRECT_URL = '/admin/login/'
\ No newline at end of file
@@ -3,6 +3,7 @@ import apiClient from '../api';
 import { MapContainer, TileLayer, Marker, Popup, Polyline } from 'react-leaflet';
 import L from 'leaflet';
 import { useNotifications } from '../context/NotificationContext.jsx'; 
+import { MSGPACK_SUBPROTOCOL, decodeFrame } from '../wire';
 
 // --- Icon fix (unchanged) ---
 let DefaultIcon = L.icon({
@@ -46,6 +47,7 @@ function BusMap() {
   const [mapCenter, setMapCenter] = useState([12.9716, 77.5946]);
   const [map, setMap] = useState(null);
   const [distance, setDistance] = useState(null); // NEW: Show distance on UI
+  const [etaSeconds, setEtaSeconds] = useState(null); // From the connect snapshot
   const myStopRef = useRef(null);
   const ws = useRef(null);
   const { addNotification } = useNotifications();
@@ -119,17 +121,53 @@ function BusMap() {
                 return;
             }
 
-            ws.current = new WebSocket(`${wsBaseUrl}/ws/track/?token=${token}`);
+            // batch=1: the server groups messages that arrive close together into one frame.
+            // The msgpack subprotocol gets binary frames (a fraction of the JSON size);
+            // a server that doesn't offer it keeps sending JSON text frames.
+            ws.current = new WebSocket(`${wsBaseUrl}/ws/track/?token=${token}&batch=1`, [MSGPACK_SUBPROTOCOL]);
+            ws.current.binaryType = 'arraybuffer';
             ws.current.onopen = () => console.log('WebSocket connected!');
 
             ws.current.onmessage = (event) => {
               if (!isMounted) return;
-              const data = JSON.parse(event.data);
+              const data = typeof event.data === 'string' ? JSON.parse(event.data) : decodeFrame(event.data);
+              if (data.type === 'batch') {
+                data.messages.forEach(handleMessage);
+              } else {
+                handleMessage(data);
+              }
+            };
+
+            const handleMessage = (data) => {
               console.log("WebSocket message received:", data);
 
-              if (data.type === 'location') {
+              if (data.type === 'snapshot') {
+                // Sent on every (re)connect: route, stops and last bus position,
+                // so a reconnect needs no REST calls
+                setRouteInfo({
+                  route_name: data.route_name,
+                  your_pickup_order: data.your_pickup_order,
+                  all_stops_on_route: data.stops,
+                });
+                const snapshotStop = data.stops.find(stop => stop.pickup_order === data.your_pickup_order);
+                if (snapshotStop) {
+                  setMyStop(snapshotStop);
+                  myStopRef.current = snapshotStop;
+                }
+                setEtaSeconds(data.eta_seconds);
+                if (data.bus && myStopRef.current) {
+                  setBusPosition([data.bus.latitude, data.bus.longitude]);
+                  setDistance(calculateDistance(
+                    data.bus.latitude, data.bus.longitude,
+                    myStopRef.current.latitude, myStopRef.current.longitude
+                  ));
+                  setBusAddress(`Last seen at ${new Date(data.bus.last_seen).toLocaleTimeString()}`);
+                }
+              }
+              else if (data.type === 'location') {
                 const newBusPos = [data.latitude, data.longitude];
                 console.log("🚌 Bus location update:", newBusPos);
+                setEtaSeconds(null); // Only known at connect time
                 fetchRouteGeometry(newBusPos);
               } 
               else if (data.type === 'notification') {
@@ -266,6 +304,12 @@ function BusMap() {
           {busPosition ? (
             <div>
               <span> {busAddress}</span>
+              {etaSeconds !== null && (
+                <div className="mt-2">
+                  <strong>Estimated arrival:</strong>
+                  <span>{` ~${Math.max(1, Math.round(etaSeconds / 60))} min`}</span>
+                </div>
+              )}
               {distance !== null && (
                 <div className="mt-2">
                   <strong>Distance to your stop:</strong>
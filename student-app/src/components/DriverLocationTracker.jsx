@@ -1,7 +1,13 @@
 import React, { useState, useRef, useEffect, useCallback } from 'react';
 import apiClient from '../api'; // Corrected import path
 
-function DriverLocationTracker() {
+const PENDING_POINTS_KEY = 'pendingLocationPoints';
+const MAX_PENDING_POINTS = 5000;
+const BATCH_SIZE = 1000; // Largest batch the server accepts
+
+// socket: ref to the dashboard's open WebSocket. Live points go over it
+// when it is connected, and fall back to an HTTP POST when it is not.
+function DriverLocationTracker({ socket }) {
   const [isTracking, setIsTracking] = useState(false);
   const [,setPosition] = useState(null);
   const [address, setAddress] = useState('Awaiting location...');
@@ -23,18 +29,84 @@ function DriverLocationTracker() {
     }
   }, []);
 
+  // Points we could not send while offline, uploaded in one batch later
+  const pendingPoints = useRef(JSON.parse(localStorage.getItem(PENDING_POINTS_KEY) || '[]'));
+  const isFlushing = useRef(false);
+
+  const savePendingPoints = () => {
+    localStorage.setItem(PENDING_POINTS_KEY, JSON.stringify(pendingPoints.current));
+  };
+
+  const queuePoint = (point) => {
+    // Keep the newest points if we are offline for a very long time
+    pendingPoints.current = [...pendingPoints.current, point].slice(-MAX_PENDING_POINTS);
+    savePendingPoints();
+  };
+
+  // Uploads the buffered points (oldest first) with the batch endpoint
+  const flushPendingPoints = useCallback(async () => {
+    if (isFlushing.current || pendingPoints.current.length === 0) return;
+    isFlushing.current = true;
+    try {
+      while (pendingPoints.current.length > 0) {
+        const batch = pendingPoints.current.slice(0, BATCH_SIZE);
+        try {
+          const response = await apiClient.post('/transport/update-location/batch/', { points: batch });
+          // Points the server couldn't use (e.g. too old) are dropped there; the rest are stored
+          if (response.data.rejected?.length) {
+            console.warn(`Server dropped ${response.data.rejected.length} invalid location point(s)`);
+          }
+        } catch (err) {
+          // Offline, session expired, server error...: keep every point and try again later
+          console.error("Failed to upload buffered locations", err);
+          return;
+        }
+        pendingPoints.current = pendingPoints.current.slice(batch.length);
+        savePendingPoints();
+      }
+    } finally {
+      isFlushing.current = false;
+    }
+  }, []);
+
   // Sends location to backend
   const sendLocation = (currentPosition) => {
     if (!currentPosition) return;
 
+    const point = {
+      latitude: currentPosition.latitude,
+      longitude: currentPosition.longitude,
+      timestamp: Date.now(),
+    };
+
+    // Offline, or still catching up: add to the queue so the order is kept
+    if (!navigator.onLine || pendingPoints.current.length > 0) {
+      queuePoint(point);
+      if (navigator.onLine) flushPendingPoints();
+      return;
+    }
+
     // Get address for display
     getAddressFromCoords(currentPosition.latitude, currentPosition.longitude);
     
-    // Send location to backend
+    // Send location to backend, on the already-open socket if we can
+    if (socket?.current?.readyState === WebSocket.OPEN) {
+      socket.current.send(JSON.stringify({
+        type: 'location',
+        latitude: point.latitude,
+        longitude: point.longitude,
+      }));
+      return;
+    }
     apiClient.post('/transport/update-location/', {
-      latitude: currentPosition.latitude,
-      longitude: currentPosition.longitude,
+      latitude: point.latitude,
+      longitude: point.longitude,
     }).catch(err => {
+      if (!err.response) {
+        // Lost signal: keep the point for the next batch upload
+        queuePoint(point);
+        return;
+      }
       console.error("Failed to send location", err);
       setError("Failed to send location. Session may be expired.");
     });
@@ -101,6 +173,13 @@ function DriverLocationTracker() {
     }
   };
   
+  // Upload anything left from an earlier session, and catch up when the signal returns
+  useEffect(() => {
+    flushPendingPoints();
+    window.addEventListener('online', flushPendingPoints);
+    return () => window.removeEventListener('online', flushPendingPoints);
+  }, [flushPendingPoints]);
+
   // Cleanup function to stop tracking if the user navigates away
   useEffect(() => {
     return () => {
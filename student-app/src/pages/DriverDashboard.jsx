@@ -135,7 +135,7 @@ function DriverDashboard() {
 
            {/* Row 3: Integrated Tracker */}
            <div className="bg-indigo-800/30 p-3 backdrop-blur-md border-t border-white/10">
-             <DriverLocationTracker />
+             <DriverLocationTracker socket={ws} />
            </div>
         </div>
       </div>
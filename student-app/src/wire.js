@@ -0,0 +1,117 @@
+// Binary frames from the bus tracking socket (see transport/wire.py on the server).
+// Asking for MSGPACK_SUBPROTOCOL when connecting makes the server send every
+// message as a compact msgpack array instead of JSON; decodeFrame() turns it
+// back into the same message objects the JSON frames hold.
+
+export const MSGPACK_SUBPROTOCOL = 'bus.msgpack.v1';
+
+const COORDINATE_SCALE = 1e6;
+
+const LOCATION = 1;
+const NOTIFICATION = 2;
+const STUDENT_CHECK_IN = 3;
+const SNAPSHOT = 4;
+const BATCH = 5;
+const ERROR = 6;
+
+const textDecoder = new TextDecoder();
+
+// Just the msgpack types the server sends: nil, booleans, integers,
+// floats, strings and arrays
+function unpack(buffer) {
+  const view = new DataView(buffer);
+  let offset = 0;
+
+  const string = (length) => {
+    const text = textDecoder.decode(new Uint8Array(buffer, offset, length));
+    offset += length;
+    return text;
+  };
+  const array = (length) => {
+    const items = [];
+    for (let i = 0; i < length; i++) items.push(read());
+    return items;
+  };
+  const take = (size, value) => {
+    offset += size;
+    return value;
+  };
+
+  const read = () => {
+    const byte = view.getUint8(offset++);
+    if (byte <= 0x7f) return byte;
+    if (byte >= 0xe0) return byte - 0x100;
+    if ((byte & 0xf0) === 0x90) return array(byte & 0x0f);
+    if ((byte & 0xe0) === 0xa0) return string(byte & 0x1f);
+    switch (byte) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xca: return take(4, view.getFloat32(offset));
+      case 0xcb: return take(8, view.getFloat64(offset));
+      case 0xcc: return take(1, view.getUint8(offset));
+      case 0xcd: return take(2, view.getUint16(offset));
+      case 0xce: return take(4, view.getUint32(offset));
+      case 0xcf: return take(8, Number(view.getBigUint64(offset)));
+      case 0xd0: return take(1, view.getInt8(offset));
+      case 0xd1: return take(2, view.getInt16(offset));
+      case 0xd2: return take(4, view.getInt32(offset));
+      case 0xd3: return take(8, Number(view.getBigInt64(offset)));
+      case 0xd9: return string(take(1, view.getUint8(offset)));
+      case 0xda: return string(take(2, view.getUint16(offset)));
+      case 0xdb: return string(take(4, view.getUint32(offset)));
+      case 0xdc: return array(take(2, view.getUint16(offset)));
+      case 0xdd: return array(take(4, view.getUint32(offset)));
+      default: throw new Error(`Unexpected msgpack byte 0x${byte.toString(16)}`);
+    }
+  };
+
+  return read();
+}
+
+const degrees = (fixed) => (fixed === null ? null : fixed / COORDINATE_SCALE);
+
+function expand(frame) {
+  switch (frame[0]) {
+    case LOCATION:
+      return { type: 'location', latitude: degrees(frame[1]), longitude: degrees(frame[2]) };
+    case NOTIFICATION:
+      return { type: 'notification', title: frame[1], body: frame[2] };
+    case STUDENT_CHECK_IN:
+      return { type: 'student_check_in', student_id: frame[1], is_boarding: frame[2] };
+    case SNAPSHOT: {
+      const [, routeName, bus, stops, yourPickupOrder, etaSeconds] = frame;
+      return {
+        type: 'snapshot',
+        route_name: routeName,
+        bus: bus && {
+          latitude: degrees(bus[0]),
+          longitude: degrees(bus[1]),
+          last_seen: new Date(bus[2] * 1000).toISOString(),
+        },
+        stops: stops.map(([id, latitude, longitude, pickupOrder, isBoardingToday, username, address]) => ({
+          id,
+          latitude: degrees(latitude),
+          longitude: degrees(longitude),
+          pickup_order: pickupOrder,
+          is_boarding_today: isBoardingToday,
+          username,
+          address,
+        })),
+        your_pickup_order: yourPickupOrder,
+        eta_seconds: etaSeconds,
+      };
+    }
+    case BATCH:
+      return { type: 'batch', messages: frame[1].map(expand) };
+    case ERROR:
+      return { type: 'error', message: frame[1] };
+    default:
+      throw new Error(`Unknown message tag: ${frame[0]}`);
+  }
+}
+
+// An ArrayBuffer from the socket as a message object
+export function decodeFrame(buffer) {
+  return expand(unpack(buffer));
+}
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-17 02:22
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0006_studentprofile_last_notification_distance'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='studentprofile',
+            name='last_notification_distance',
+        ),
+    ]
@@ -30,13 +30,6 @@ class StudentProfile(models.Model):
     )
 
     is_boarding_today = models.BooleanField(default=False)
-    
-    # NEW FIELD: Track the last notification threshold sent
-    last_notification_distance = models.IntegerField(
-        blank=True,
-        null=True,
-        help_text="Last geofence threshold (in meters) for which a notification was sent"
-    )
 
     def __str__(self):
         return self.user.username
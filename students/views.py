@@ -252,7 +252,7 @@ def check_in_view(request):
         if new_status is None or not isinstance(new_status, bool):
             return Response({'error': 'is_boarding (boolean) is required.'}, status=400)
         
-        # 1. Save new status to database
+        # 1. Save new status to database (the route's cached stops are dropped by a signal)
         profile.is_boarding_today = new_status
         profile.save()
 
@@ -6,9 +6,11 @@ from django.utils.safestring import mark_safe
 import json
 from django.conf import settings # Import settings to get college coords
 from .models import Route # Only import Route
+from .matrix import get_matrix_provider, estimate_durations
 from drivers.models import DriverProfile
 from students.models import StudentProfile
 import requests
+import numpy as np
 
 @admin.register(Route)
 class RouteAdmin(admin.ModelAdmin):
@@ -16,7 +18,7 @@ class RouteAdmin(admin.ModelAdmin):
     change_form_template = 'admin/transport/route/change_form.html'
 
     # 2. Define fields shown in the main list view (This stays the same)
-    list_display = ('name', 'assigned_driver', 'student_count')
+    list_display = ('name', 'assigned_driver', 'student_count', 'capacity')
 
     # --- Helper methods for list_display (These stay the same) ---
     def student_count(self, obj):
@@ -49,8 +51,11 @@ class RouteAdmin(admin.ModelAdmin):
             college_coords = settings.COLLEGE_COORDS
 
             if students:
+                located_students = []
+                travel_times = get_matrix_provider()  # settings.TRAVEL_TIME_PROVIDER
                 for student in students:
                     if student.latitude and student.longitude:
+                        located_students.append(student)
                         student_locations.append({
                             'lat': student.latitude,
                             'lng': student.longitude,
@@ -69,13 +74,40 @@ class RouteAdmin(admin.ModelAdmin):
                         json=body, headers=headers, timeout=10
                     )
                     if res.status_code == 200:
-                        geom = res.json()['features'][0]['geometry']['coordinates']
+                        feature = res.json()['features'][0]
+                        geom = feature['geometry']['coordinates']
                         # Convert [lon, lat] to [lat, lon] for Leaflet
                         polyline = [[coord[1], coord[0]] for coord in geom]
                         extra_context['route_polyline_json'] = mark_safe(json.dumps(polyline))
+
+                        # Each segment is one leg between stops; keep them in the
+                        # driving time cache so the next lookup needs no ORS call
+                        segments = feature['properties'].get('segments', [])
+                        if len(segments) == len(ors_coordinates) - 1 and hasattr(travel_times, 'remember'):
+                            travel_times.remember(
+                                ors_coordinates[:-1], ors_coordinates[1:],
+                                [segment.get('duration') for segment in segments],
+                                [segment.get('distance') for segment in segments],
+                            )
                 except Exception as e:
                     print(f"Admin map route-line failed: {e}")
                     extra_context['route_polyline_json'] = mark_safe(json.dumps([]))
+
+                # Driving time from each stop to the next one (cache first)
+                estimates = estimate_durations(ors_coordinates[:-1], ors_coordinates[1:]).diagonal()
+                try:
+                    if hasattr(travel_times, 'pairs'):
+                        leg_seconds = travel_times.pairs(ors_coordinates[:-1], ors_coordinates[1:])
+                    else:
+                        leg_seconds = travel_times.matrix(ors_coordinates)['durations'].diagonal(1)
+                except Exception as e:
+                    print(f"Admin map leg times failed, using estimates: {e}")
+                    leg_seconds = estimates
+                # Legs ORS can't route come back as NaN: use the estimate for those
+                leg_seconds = np.where(np.isnan(leg_seconds), estimates, leg_seconds)
+                for student, seconds in zip(located_students, leg_seconds):
+                    student.leg_minutes = round(seconds / 60)
+                extra_context['route_total_minutes'] = round(sum(leg_seconds) / 60)
             # --- End Polyline ---
 
             # Pass student locations JSON to template
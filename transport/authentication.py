@@ -0,0 +1,28 @@
+# transport/authentication.py
+from django.core.cache import cache
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+# How long a token's user is reused without asking the database (seconds)
+USER_CACHE_TIMEOUT = 60
+
+
+def user_cache_key(user_id):
+    return f"jwt_user:{user_id}"
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that keeps the token's user in the cache for
+    USER_CACHE_TIMEOUT seconds. Used on high-frequency endpoints
+    (location pings) so they don't load the user on every request.
+    Saving a user drops its entry (see transport/signals.py).
+    """
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        user = cache.get(user_cache_key(user_id)) if user_id is not None else None
+        if user is None or not user.is_active:
+            user = super().get_user(validated_token)
+            cache.set(user_cache_key(user_id), user, USER_CACHE_TIMEOUT)
+        return user
@@ -1,3 +1,4 @@
+import asyncio
 import json
 # 1. Import the ASYNC consumer
 from channels.generic.websocket import AsyncWebsocketConsumer
@@ -7,17 +8,41 @@ from rest_framework_simplejwt.tokens import AccessToken
 from channels.db import database_sync_to_async
 from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
 from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ValidationError
 from urllib.parse import parse_qs
 
-# Import models to check roles
-from students.models import StudentProfile
-from drivers.models import DriverProfile
+from .models import OptimizationJob
+from .jobs import fail_if_orphaned, job_group_name, serialize_job
+from .history import get_trace, to_datetime
+from .route_cache import get_driver_assignment
+from .tracking import route_group_name, route_snapshot, student_group_name, track_location
+from . import wire
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+# How long a token's role and route are reused on reconnects (seconds)
+SOCKET_IDENTITY_TIMEOUT = 60
+
+_REJECTED = (AnonymousUser(), None, None, None, None)
+
+
+def socket_identity_key(user_id):
+    # Per user, so transport/signals.py can drop it when the user,
+    # their profile or their route changes
+    return f"ws_identity:{user_id}"
+
 
 @database_sync_to_async
 def get_user_from_scope(scope):
     """
     Gets user from JWT token in query string.
-    Also identifies their role, route, and student ID if applicable.
+    Also identifies their role, route (id and name), and student ID if applicable.
+    The user and both profiles (with their routes) are loaded in one
+    query, and an accepted identity is cached per user for
+    SOCKET_IDENTITY_TIMEOUT seconds, so a burst of reconnects (e.g.
+    after a deploy) mostly skips the database. Rejections are not
+    cached: a student given a route can connect straight away.
     """
     try:
         query_string = scope.get('query_string', b'').decode()
@@ -26,115 +51,348 @@ def get_user_from_scope(scope):
         
         if not token_key:
             print("WebSocket Auth: No token. Rejecting.")
-            return AnonymousUser(), None, None, None
+            return _REJECTED
 
+        # Signature and expiry are checked every time, cached or not
         token = AccessToken(token_key)
-        user_id = token.payload.get('user_id')
-        user = User.objects.get(id=user_id)
-        
-        # Check for driver role
-        try:
-            driver_profile = DriverProfile.objects.get(user=user)
-            if driver_profile.route_assigned:
-                route_name = driver_profile.route_assigned.name
-                return user, 'driver', route_name, None
-            else:
-                print(f"WebSocket: Driver {user.username} has no route. Rejecting.")
-                return AnonymousUser(), None, None, None
-        except DriverProfile.DoesNotExist:
-            pass 
-
-        # Check for student role
-        try:
-            student_profile = StudentProfile.objects.get(user=user)
-            if student_profile.route:
-                route_name = student_profile.route.name
-                student_id = student_profile.id
-                return user, 'student', route_name, student_id
-            else:
-                print(f"WebSocket: Student {user.username} is on waitlist. Rejecting.")
-                return AnonymousUser(), None, None, None
-        except StudentProfile.DoesNotExist:
-            pass
-
-        print(f"WebSocket: User {user.username} has no valid role. Rejecting.")
-        return AnonymousUser(), None, None, None
+        key = socket_identity_key(token.payload.get('user_id'))
+        identity = cache.get(key)
+        if identity is None:
+            identity = resolve_identity(token.payload.get('user_id'))
+            if identity is not _REJECTED:
+                cache.set(key, identity, SOCKET_IDENTITY_TIMEOUT)
+        return identity
 
-    except (TokenError, InvalidToken, User.DoesNotExist) as e:
+    except (TokenError, InvalidToken) as e:
         print(f"WebSocket Auth Error: {e}. Rejecting.")
-        return AnonymousUser(), None, None, None
+        return _REJECTED
     except Exception as e:
         print(f"WebSocket Auth Error (General): {e}. Rejecting.")
-        return AnonymousUser(), None, None, None
+        return _REJECTED
+
+
+def resolve_identity(user_id):
+    """(user, role, route id, route name, student id) for a user id, in one query."""
+    user = User.objects.select_related(
+        'driverprofile__route_assigned', 'studentprofile__route'
+    ).filter(id=user_id, is_active=True).first()
+    if user is None:
+        print(f"WebSocket Auth Error: no active user {user_id}. Rejecting.")
+        return _REJECTED
+
+    # Check for driver role
+    driver_profile = getattr(user, 'driverprofile', None)
+    if driver_profile is not None:
+        if driver_profile.route_assigned:
+            route = driver_profile.route_assigned
+            return user, 'driver', route.id, route.name, None
+        print(f"WebSocket: Driver {user.username} has no route. Rejecting.")
+        return _REJECTED
+
+    # Check for student role
+    student_profile = getattr(user, 'studentprofile', None)
+    if student_profile is not None:
+        if student_profile.route:
+            route = student_profile.route
+            return user, 'student', route.id, route.name, student_profile.id
+        print(f"WebSocket: Student {user.username} is on waitlist. Rejecting.")
+        return _REJECTED
+
+    print(f"WebSocket: User {user.username} has no valid role. Rejecting.")
+    return _REJECTED
+
+
+@database_sync_to_async
+def get_route_snapshot(route_id, route_name, student_id):
+    return route_snapshot(route_id, route_name, student_id)
+
+
+@database_sync_to_async
+def handle_driver_location(user_id, username, latitude, longitude):
+    """Runs a location frame through the ping pipeline. False if the driver has no route."""
+    assignment = get_driver_assignment(user_id)
+    if assignment is None or assignment['route_id'] is None:
+        return False
+    track_location(assignment, latitude, longitude, driver_name=username)
+    return True
+
+
+# How long a batching socket collects messages before sending (seconds)
+COALESCE_WINDOW = 0.1
 
 
 class BusConsumer(AsyncWebsocketConsumer):
-    
+    """
+    Live bus tracking for a route's students and driver (ws/track/).
+
+    Clients can opt into batching with ?batch=1: messages that arrive
+    within COALESCE_WINDOW are sent as one {"type": "batch", "messages":
+    [...]} frame, and a location update replaces any older one still
+    waiting, so a busy route wakes the phone's radio less often.
+
+    Clients that request the wire.MSGPACK_SUBPROTOCOL subprotocol get
+    binary msgpack frames (see transport/wire.py) instead of JSON.
+    """
+
     async def connect(self):
-        # 1. Get user, role, route name, and student ID
-        self.user, self.role, route_name, self.student_id = await get_user_from_scope(self.scope)
+        # 1. Get user, role, route, and student ID
+        self.user, self.role, self.route_id, route_name, self.student_id = await get_user_from_scope(self.scope)
         
         if not self.user.is_authenticated:
             await self.close()
             return
             
         # 2. Create group name
-        self.channel_group_name = f"bus_route_{route_name.replace(' ', '_')}"
+        self.channel_group_name = route_group_name(route_name)
 
-        # 3. Subscribe
+        # 3. Subscribe (students also get their own group for targeted notifications)
         await self.channel_layer.group_add(
             self.channel_group_name,
             self.channel_name
         )
+        if self.role == 'student':
+            await self.channel_layer.group_add(student_group_name(self.student_id), self.channel_name)
 
         # 4. Accept
-        await self.accept()
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        self.batching = params.get('batch', ['0'])[0] == '1'
+        self.outbox = []
+        self.flush_task = None
+        self.binary = wire.MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        await self.accept(subprotocol=wire.MSGPACK_SUBPROTOCOL if self.binary else None)
         print(f"WebSocket: {self.role} {self.user.username} (Student ID: {self.student_id}) connected to {self.channel_group_name}")
 
+        # 5. Send the current state straight away instead of waiting for the next ping
+        snapshot = await get_route_snapshot(self.route_id, route_name, self.student_id)
+        await self.send_message(snapshot)
+
     async def disconnect(self, close_code):
+        if getattr(self, 'flush_task', None) is not None:
+            self.flush_task.cancel()
         if hasattr(self, 'channel_group_name'):
             await self.channel_layer.group_discard(
                 self.channel_group_name,
                 self.channel_name
             )
+            if self.role == 'student':
+                await self.channel_layer.group_discard(student_group_name(self.student_id), self.channel_name)
             print(f"WebSocket: {self.role} {self.user.username} disconnected.")
 
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Drivers send their location on this socket instead of POSTing
+        to update-location/: {"type": "location", "latitude", "longitude"}
+        (or [1, lat, lon] on a msgpack socket). The socket is already
+        authenticated, so a frame goes straight to the same
+        history/broadcast/geofence pipeline.
+        """
+        if self.role != 'driver':
+            return
+        try:
+            message = wire.decode(bytes_data) if bytes_data is not None else json.loads(text_data or '')
+            if message.get('type') != 'location':
+                raise ValueError(f"Unknown message type: {message.get('type')}")
+            latitude = float(message['latitude'])
+            longitude = float(message['longitude'])
+            if not (abs(latitude) <= 90 and abs(longitude) <= 180):
+                raise ValueError("Latitude or longitude out of range.")
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            await self.emit({'type': 'error', 'message': f"Invalid location frame: {e}"})
+            return
+
+        if not await handle_driver_location(self.user.id, self.user.username, latitude, longitude):
+            await self.emit({'type': 'error', 'message': 'You are not assigned to a route.'})
+
+    # --- Outgoing messages ---
+
+    async def send_message(self, message):
+        """One frame, in the format the client negotiated."""
+        if self.binary:
+            await self.send(bytes_data=wire.encode(message))
+        else:
+            await self.send(text_data=json.dumps(message))
+
+    async def emit(self, message):
+        """Sends a message now, or queues it when the client asked for batching."""
+        if not self.batching:
+            await self.send_message(message)
+            return
+        if message['type'] == 'location':
+            # Only the newest position matters
+            self.outbox = [queued for queued in self.outbox if queued['type'] != 'location']
+        self.outbox.append(message)
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_outbox())
+
+    async def flush_outbox(self):
+        await asyncio.sleep(COALESCE_WINDOW)
+        messages, self.outbox, self.flush_task = self.outbox, [], None
+        if len(messages) == 1:
+            await self.send_message(messages[0])
+        elif messages:
+            await self.send_message({'type': 'batch', 'messages': messages})
+
     # --- Message Handlers (must all be async) ---
 
     async def send_bus_location(self, event):
         """Send bus location updates to all connected clients"""
-        await self.send(text_data=json.dumps({
+        await self.emit({
             'type': 'location',
             'latitude': event['latitude'],
             'longitude': event['longitude']
-        }))
+        })
 
     async def send_arrival_notification(self, event):
         """
-        Send notification to students only.
-        If target_student_id is provided, only send to that specific student.
+        Send notification to students only. Route-wide broadcasts come
+        through the route group; notifications for one student are sent
+        to that student's own group, so they only reach their sockets.
         """
         if self.role == 'student':
-            # Check if this notification is targeted at a specific student
-            target_student_id = event.get('target_student_id')
-            
-            # If no target specified, send to all students (broadcast)
-            # If target specified, only send if it matches this student's ID
-            if target_student_id is None or target_student_id == self.student_id:
-                print(f"[WebSocket] Sending notification to {self.user.username}: {event.get('title')}")
-                await self.send(text_data=json.dumps({
-                    'type': 'notification',
-                    'title': event['title'],
-                    'body': event['body']
-                }))
-            else:
-                print(f"[WebSocket] Skipping notification for {self.user.username} (targeted at student {target_student_id})")
+            print(f"[WebSocket] Sending notification to {self.user.username}: {event.get('title')}")
+            await self.emit({
+                'type': 'notification',
+                'title': event['title'],
+                'body': event['body']
+            })
 
     async def student_check_in(self, event):
         """Send check-in status updates to drivers"""
         if self.role == 'driver':
-            await self.send(text_data=json.dumps({
+            await self.emit({
                 'type': 'student_check_in',
                 'student_id': event['student_id'],
                 'is_boarding': event['is_boarding']
-            }))
\ No newline at end of file
+            })
+
+@database_sync_to_async
+def get_staff_user_from_scope(scope):
+    """
+    Returns the staff user for an admin WebSocket, or None.
+    Admin pages are signed in with the session cookie; API clients
+    can pass their JWT as ?token= like the bus socket does.
+    """
+    user = scope.get('user')
+    if user is not None and user.is_authenticated and user.is_staff:
+        return user
+    try:
+        params = parse_qs(scope.get('query_string', b'').decode())
+        token_key = params.get('token', [None])[0]
+        if not token_key:
+            return None
+        user = User.objects.get(id=AccessToken(token_key).payload.get('user_id'))
+        return user if user.is_staff else None
+    except (TokenError, InvalidToken, User.DoesNotExist) as e:
+        print(f"WebSocket Auth Error: {e}. Rejecting.")
+        return None
+
+
+@database_sync_to_async
+def get_job_snapshot(job_id):
+    try:
+        return serialize_job(fail_if_orphaned(OptimizationJob.objects.get(id=job_id)))
+    except (OptimizationJob.DoesNotExist, ValidationError):
+        return None
+
+
+class OptimizationJobConsumer(AsyncWebsocketConsumer):
+    """
+    Streams the progress of one background optimization job
+    (see transport/jobs.py) to an admin.
+    """
+
+    async def connect(self):
+        self.user = await get_staff_user_from_scope(self.scope)
+        if self.user is None:
+            await self.close()
+            return
+
+        job_id = self.scope['url_route']['kwargs']['job_id']
+        snapshot = await get_job_snapshot(job_id)
+        if snapshot is None:
+            await self.close()
+            return
+
+        self.channel_group_name = job_group_name(job_id)
+        await self.channel_layer.group_add(self.channel_group_name, self.channel_name)
+        await self.accept()
+
+        # Send what has happened so far, then live lines follow
+        await self.send(text_data=json.dumps({'type': 'optimization_snapshot', **snapshot}))
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'channel_group_name'):
+            await self.channel_layer.group_discard(
+                self.channel_group_name,
+                self.channel_name
+            )
+
+    async def optimization_progress(self, event):
+        """Forward one progress event (a log line and/or status change)"""
+        await self.send(text_data=json.dumps({
+            'type': 'optimization_progress',
+            'job_id': event['job_id'],
+            'status': event['status'],
+            'line': event['line'],
+        }))
+
+
+# Replay limits: most points streamed, and longest pause between two frames
+REPLAY_MAX_POINTS = 5000
+REPLAY_MAX_GAP = 2.0  # seconds
+
+
+@database_sync_to_async
+def get_replay_points(route_id, day):
+    return get_trace(route_id, day, REPLAY_MAX_POINTS)
+
+
+class TraceReplayConsumer(AsyncWebsocketConsumer):
+    """
+    Replays a route's recorded GPS trace to an admin, using the same
+    'location' frames BusConsumer sends for the live bus.
+
+        ws/replay/<route_id>/?date=YYYY-MM-DD&speed=10
+
+    speed is how many times faster than real time to play (default 10).
+    A 'replay_complete' frame is sent at the end.
+    """
+
+    async def connect(self):
+        self.user = await get_staff_user_from_scope(self.scope)
+        if self.user is None:
+            await self.close()
+            return
+
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            date_param = params.get('date', [None])[0]
+            day = parse_date(date_param) if date_param else timezone.localdate()
+            speed = float(params.get('speed', [10])[0])
+            if day is None or speed <= 0:
+                raise ValueError
+        except ValueError:
+            await self.close()
+            return
+
+        route_id = int(self.scope['url_route']['kwargs']['route_id'])
+        await self.accept()
+        self.replay = asyncio.ensure_future(self.play(await get_replay_points(route_id, day), speed))
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'replay'):
+            self.replay.cancel()
+
+    async def play(self, points, speed):
+        previous = None
+        for t, lat, lon in points:
+            if previous is not None:
+                await asyncio.sleep(min((t - previous) / speed, REPLAY_MAX_GAP))
+            previous = t
+            await self.send(text_data=json.dumps({
+                'type': 'location',
+                'latitude': float(lat),
+                'longitude': float(lon),
+                'timestamp': to_datetime(t).isoformat(),
+            }))
+        await self.send(text_data=json.dumps({'type': 'replay_complete', 'points': len(points)}))
@@ -0,0 +1,115 @@
+# transport/geofence.py
+"""
+Geofence checks for a bus's location pings.
+
+A RouteGeofence holds the stops of one route as NumPy arrays, so each
+ping is a single vectorized step no matter how many stops there are:
+
+    fence = RouteGeofence.from_students(route.students.all())
+    notifications = fence.evaluate(longitude, latitude, notified)
+    # notified: {student_id: last threshold sent}, updated in place
+
+Each student is told once per threshold as the bus gets closer
+(500m, 400m, ... 100m), once more at the final 30m "bus is here"
+call, and the tracking resets when the bus is more than 500m away.
+"""
+import numpy as np
+
+from .utils import haversine_matrix
+
+# Notification thresholds in meters. The last one is the final call,
+# only sent once until the student's tracking is reset.
+NOTIFICATION_DISTANCES = [500, 400, 300, 200, 100, 30]
+FINAL_THRESHOLD = 30
+
+_THRESHOLDS = np.array(sorted(NOTIFICATION_DISTANCES), dtype=float)
+
+
+class RouteGeofence:
+    """
+    Stop positions and boarding flags for one route.
+    Only students boarding today are notified.
+    """
+
+    def __init__(self, student_ids, longitudes, latitudes, boarding):
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.boarding = np.asarray(boarding, dtype=bool)
+
+    @classmethod
+    def from_students(cls, students):
+        """Builds a fence from a StudentProfile queryset (stops without a location are skipped)."""
+        rows = list(
+            students.filter(latitude__isnull=False, longitude__isnull=False)
+            .values_list('id', 'longitude', 'latitude', 'is_boarding_today')
+        )
+        columns = list(zip(*rows)) if rows else [[], [], [], []]
+        return cls(*columns)
+
+    def evaluate(self, longitude, latitude, notified):
+        """
+        Checks one ping against every stop.
+
+        notified maps student id -> last threshold sent this trip and
+        is updated in place. Returns a list of notifications to send,
+        each a dict with student_id, threshold, distance (meters) and
+        final.
+        """
+        if not len(self.student_ids):
+            return []
+
+        meters = np.floor(haversine_matrix(
+            [float(longitude)], [float(latitude)], self.longitudes, self.latitudes
+        )[0] * 1000)
+        # Smallest threshold each stop is inside of (or past the end if outside all)
+        index = np.searchsorted(_THRESHOLDS, meters, side='left')
+        inside = index < len(_THRESHOLDS)
+        outside = ~inside & self.boarding
+        inside &= self.boarding
+        current = np.where(inside, _THRESHOLDS[np.minimum(index, len(_THRESHOLDS) - 1)], np.nan)
+        last = np.fromiter(
+            (notified.get(int(i), np.nan) for i in self.student_ids), dtype=float, count=len(self.student_ids)
+        )
+        never = np.isnan(last)
+
+        final = inside & (current <= FINAL_THRESHOLD) & (last != FINAL_THRESHOLD)
+        closer = inside & (current > FINAL_THRESHOLD) & (never | (current < last))
+        send = final | closer
+
+        # Out of range: forget what we told them so the next approach starts over
+        for i in np.flatnonzero(outside & ~never):
+            del notified[int(self.student_ids[i])]
+        for i in np.flatnonzero(send):
+            notified[int(self.student_ids[i])] = FINAL_THRESHOLD if final[i] else int(current[i])
+
+        return [
+            {
+                'student_id': int(self.student_ids[i]),
+                'threshold': int(current[i]),
+                'distance': int(meters[i]),
+                'final': bool(final[i]),
+            }
+            for i in np.flatnonzero(send)
+        ]
+
+
+def notification_message(route_name, notification):
+    """
+    The channel-layer event for one notification from evaluate(),
+    to be sent to the student's own group (tracking.student_group_name).
+    """
+    if notification['final']:
+        title = f"🚨 Bus is HERE! ({notification['distance']}m)"
+        body = f"FINAL CALL! The bus for {route_name} is at your stop. Please be ready!"
+    else:
+        title = f"Bus is ~{notification['threshold']}m away!"
+        body = (
+            f"The bus for {route_name} is approaching your stop. "
+            f"Current distance: {notification['distance']}m"
+        )
+    return {
+        'type': 'send_arrival_notification',
+        'title': title,
+        'body': body,
+    }
@@ -0,0 +1,140 @@
+# transport/history.py
+"""
+GPS history for every bus, stored as packed arrays.
+
+Pings are appended to an in-process buffer (cheap, no database) and
+written out by the location flusher (transport/locations.py) as one
+LocationChunk row per route and day, all in a single bulk_create:
+
+    append_points(route_id, [(timestamp, latitude, longitude), ...])
+    flush_history()  # run by the flusher; use locations.append_history() to start it
+    get_trace(route_id, day, max_points=500)  # downsampled trip trace
+
+Each point takes 16 bytes: a float64 Unix timestamp plus float32
+latitude/longitude (good to well under a meter).
+"""
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+from django.utils import timezone
+
+from .models import LocationChunk
+
+POINT_DTYPE = np.dtype([('t', '<f8'), ('lat', '<f4'), ('lon', '<f4')])
+# Points returned by get_trace() unless asked otherwise
+DEFAULT_TRACE_POINTS = 500
+
+_buffer = defaultdict(list)  # route id -> [(unix time, lat, lon), ...]
+_lock = threading.Lock()
+
+
+def _unix_time(value):
+    return value.timestamp() if isinstance(value, datetime) else float(value)
+
+
+def to_datetime(unix_time):
+    return datetime.fromtimestamp(float(unix_time), tz=dt_timezone.utc)
+
+
+def append_points(route_id, points):
+    """
+    Queues points for a route: an iterable of (timestamp, latitude,
+    longitude), timestamp as a datetime or Unix seconds.
+    """
+    rows = [(_unix_time(t), float(lat), float(lon)) for t, lat, lon in points]
+    with _lock:
+        _buffer[route_id].extend(rows)
+
+
+def flush_history():
+    """
+    Writes every queued point as LocationChunk rows (one per route
+    and local day) in one bulk_create. Returns the number of points.
+    """
+    global _buffer
+    with _lock:
+        pending, _buffer = _buffer, defaultdict(list)
+    if not pending:
+        return 0
+
+    chunks = []
+    for route_id, rows in pending.items():
+        points = np.array(rows, dtype=POINT_DTYPE)
+        points.sort(order='t', kind='stable')
+        first_day = timezone.localdate(to_datetime(points['t'][0]))
+        if first_day == timezone.localdate(to_datetime(points['t'][-1])):
+            days = np.full(len(points), first_day)  # The usual case: no midnight in this batch
+        else:
+            days = np.array([timezone.localdate(to_datetime(t)) for t in points['t']])
+        for day in np.unique(days):
+            part = points[days == day]
+            chunks.append(LocationChunk(
+                route_id=route_id,
+                day=day,
+                start_time=to_datetime(part['t'][0]),
+                end_time=to_datetime(part['t'][-1]),
+                point_count=len(part),
+                data=part.tobytes(),
+            ))
+
+    try:
+        LocationChunk.objects.bulk_create(chunks)
+    except Exception:
+        # Keep the points for the next flush
+        with _lock:
+            for route_id, rows in pending.items():
+                _buffer[route_id][:0] = rows
+        raise
+    return sum(chunk.point_count for chunk in chunks)
+
+
+def load_points(route_id, day, start=None, end=None):
+    """
+    Every stored point for a route on a day (optionally between two
+    datetimes), as one POINT_DTYPE array sorted by time. Points this
+    process has not flushed yet are included too.
+    """
+    chunks = LocationChunk.objects.filter(route_id=route_id, day=day)
+    if start is not None:
+        chunks = chunks.filter(end_time__gte=start)
+    if end is not None:
+        chunks = chunks.filter(start_time__lte=end)
+
+    parts = [np.frombuffer(bytes(data), dtype=POINT_DTYPE) for data in chunks.values_list('data', flat=True)]
+    with _lock:
+        queued = list(_buffer.get(route_id, []))
+    if queued:
+        queued = np.array(queued, dtype=POINT_DTYPE)
+        on_day = np.array([timezone.localdate(to_datetime(t)) == day for t in queued['t']])
+        parts.append(queued[on_day])
+    if not parts:
+        return np.empty(0, dtype=POINT_DTYPE)
+    points = np.concatenate(parts)
+    points.sort(order='t', kind='stable')
+
+    keep = np.ones(len(points), dtype=bool)
+    if start is not None:
+        keep &= points['t'] >= _unix_time(start)
+    if end is not None:
+        keep &= points['t'] <= _unix_time(end)
+    return points[keep]
+
+
+def downsample(points, max_points):
+    """
+    Evenly spaced subset of at most max_points points, always
+    keeping the first and last one.
+    """
+    if len(points) <= max_points:
+        return points
+    if max_points < 2:
+        return points[:max_points]
+    index = np.unique(np.linspace(0, len(points) - 1, max_points).round().astype(int))
+    return points[index]
+
+
+def get_trace(route_id, day, max_points=DEFAULT_TRACE_POINTS, start=None, end=None):
+    """A route's trip on a day as a downsampled POINT_DTYPE array."""
+    return downsample(load_points(route_id, day, start, end), max_points)
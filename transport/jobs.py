@@ -0,0 +1,241 @@
+# transport/jobs.py
+"""
+Runs optimize_routes in the background so admin requests return
+straight away.
+
+    job = submit_optimization(user=request.user)
+    # -> poll /api/transport/admin/optimization-jobs/<job.id>/
+    # -> or listen on ws/optimization/<job.id>/
+
+Jobs run one at a time in a small thread pool inside the web process.
+While a job runs its output is kept in the cache (the command holds a
+database transaction open, so log rows would not be visible yet) and
+every line is pushed to the job's WebSocket group. When it finishes,
+the full log is saved on the OptimizationJob row.
+
+Queued and running jobs only live in that process, so it keeps a
+heartbeat in the cache for each of them. A job whose heartbeat is gone
+(the server restarted or crashed) is marked failed the next time it is
+polled or another job is submitted; see fail_if_orphaned().
+"""
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .models import OptimizationJob
+
+# One worker: two optimizations at once would fight over the same students
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='optimize-routes')
+
+LIVE_LOG_TIMEOUT = 60 * 60  # seconds
+LIVE_LOG_SAVE_SECONDS = 1  # how often a running job's log is copied to the cache
+HEARTBEAT_INTERVAL = 30  # seconds
+HEARTBEAT_TIMEOUT = 5 * 60  # seconds without a heartbeat before a job counts as lost
+ORPHANED_ERROR = "The server stopped before this job finished. Please run it again."
+
+_active_jobs = set()  # queued or running in this process
+_active_lock = threading.Lock()
+_heartbeat_thread = None
+
+
+def job_group_name(job_id):
+    """WebSocket group that receives a job's progress events."""
+    return f"optimization_job_{job_id}"
+
+
+def _live_log_key(job_id):
+    return f"optimization_job_log:{job_id}"
+
+
+def _heartbeat_key(job_id):
+    return f"optimization_job_heartbeat:{job_id}"
+
+
+def _beat(job_ids):
+    cache.set_many({_heartbeat_key(job_id): time.time() for job_id in job_ids}, HEARTBEAT_TIMEOUT)
+
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        with _active_lock:
+            job_ids = list(_active_jobs)
+        try:
+            _beat(job_ids)
+        except Exception as e:
+            print(f"Error refreshing optimization job heartbeats: {e}")
+
+
+def _queue(job_id):
+    """Starts the heartbeat for a job and hands it to the worker."""
+    global _heartbeat_thread
+    with _active_lock:
+        _active_jobs.add(job_id)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(
+                target=_heartbeat_loop, name='optimize-routes-heartbeat', daemon=True
+            )
+            _heartbeat_thread.start()
+    _beat([job_id])
+    _executor.submit(_run_job, job_id)
+
+
+def fail_if_orphaned(job):
+    """
+    Marks a queued or running job as failed if no process has sent a
+    heartbeat for it within HEARTBEAT_TIMEOUT. Returns the job, reloaded
+    if it changed.
+    """
+    unfinished = (OptimizationJob.STATUS_QUEUED, OptimizationJob.STATUS_RUNNING)
+    if job.status not in unfinished:
+        return job
+    # Just created: the heartbeat starts once the creating transaction commits
+    if job.created_at > timezone.now() - timedelta(seconds=HEARTBEAT_TIMEOUT):
+        return job
+    if cache.get(_heartbeat_key(job.id)) is not None:
+        return job
+
+    failed = OptimizationJob.objects.filter(id=job.id, status__in=unfinished).update(
+        status=OptimizationJob.STATUS_FAILED,
+        error=ORPHANED_ERROR,
+        log=cache.get(_live_log_key(job.id), job.log),
+        finished_at=timezone.now(),
+    )
+    if failed:
+        cache.delete(_live_log_key(job.id))
+        _send_progress(job.id, OptimizationJob.STATUS_FAILED)
+    job.refresh_from_db()
+    return job
+
+
+def fail_orphaned_jobs():
+    """fail_if_orphaned() for every queued or running job."""
+    unfinished = OptimizationJob.objects.filter(
+        status__in=[OptimizationJob.STATUS_QUEUED, OptimizationJob.STATUS_RUNNING]
+    )
+    for job in unfinished:
+        fail_if_orphaned(job)
+
+
+def get_job_log(job):
+    """The job's output so far (live while running, saved once finished)."""
+    if job.status == OptimizationJob.STATUS_RUNNING:
+        return cache.get(_live_log_key(job.id), '')
+    return job.log
+
+
+def serialize_job(job):
+    """Plain dict used by the polling endpoint and WebSocket snapshot."""
+    return {
+        'job_id': str(job.id),
+        'status': job.status,
+        'options': job.options,
+        'log': get_job_log(job),
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def _send_progress(job_id, status, line=''):
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            job_group_name(job_id),
+            {
+                'type': 'optimization_progress',
+                'job_id': str(job_id),
+                'status': status,
+                'line': line,
+            }
+        )
+    except Exception as e:
+        print(f"Error sending optimization progress: {e}")
+
+
+class JobOutput:
+    """
+    File-like object handed to call_command as stdout.
+    Every write is broadcast; the live log in the cache is rewritten
+    at most every LIVE_LOG_SAVE_SECONDS, so a long run doesn't resend
+    its whole log for each line.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.parts = []
+        self.saved_at = 0.0
+
+    def write(self, text):
+        self.parts.append(text)
+        if time.monotonic() - self.saved_at >= LIVE_LOG_SAVE_SECONDS:
+            self.save()
+        _send_progress(self.job_id, OptimizationJob.STATUS_RUNNING, text.rstrip('\n'))
+
+    def save(self):
+        """Puts everything written so far in the live log."""
+        cache.set(_live_log_key(self.job_id), self.getvalue(), LIVE_LOG_TIMEOUT)
+        self.saved_at = time.monotonic()
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+def _run_job(job_id):
+    """Body of a background job (runs in the worker thread)."""
+    close_old_connections()
+    output = JobOutput(job_id)
+    try:
+        job = OptimizationJob.objects.get(id=job_id)
+        job.status = OptimizationJob.STATUS_RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=['status', 'started_at'])
+        _send_progress(job_id, job.status)
+
+        try:
+            call_command('optimize_routes', stdout=output, **job.options)
+            job.status = OptimizationJob.STATUS_SUCCEEDED
+        except Exception as e:
+            print(f"Optimization job {job_id} failed: {e}")
+            traceback.print_exc()
+            job.status = OptimizationJob.STATUS_FAILED
+            job.error = str(e)
+
+        job.log = output.getvalue()
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'log', 'error', 'finished_at'])
+        cache.delete(_live_log_key(job_id))
+        _send_progress(job_id, job.status)
+    finally:
+        with _active_lock:
+            _active_jobs.discard(job_id)
+        cache.delete(_heartbeat_key(job_id))
+        # This thread keeps its own DB connection; don't leak it
+        connection.close()
+
+
+def submit_optimization(user=None, **options):
+    """
+    Creates an OptimizationJob and queues it. Returns the job
+    immediately; the command runs once the current transaction
+    (if any) commits. Jobs lost in an earlier restart are failed first.
+    """
+    fail_orphaned_jobs()
+    job = OptimizationJob.objects.create(
+        options=options,
+        created_by=user if user is not None and user.is_authenticated else None,
+    )
+    transaction.on_commit(lambda: _queue(job.id))
+    return job
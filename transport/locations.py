@@ -0,0 +1,127 @@
+# transport/locations.py
+"""
+Live bus positions with write-behind to the database.
+
+Every ping updates the cache straight away (that is what readers see)
+and is parked in an in-process buffer. A background thread writes the
+newest position per driver to DriverProfile every
+settings.LOCATION_FLUSH_SECONDS with one bulk_update:
+
+    record_location(assignment, latitude, longitude, driver_name=...)
+    get_live_location(route_id)  # -> dict or None (fall back to the DB)
+    append_history(route_id, points)  # GPS history, see transport/history.py
+
+The same thread writes the GPS history queued in transport/history.py.
+A crash loses at most one flush interval of last-known positions and
+history; the live view in the cache is unaffected.
+"""
+import atexit
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+from drivers.models import DriverProfile
+
+from .history import append_points, flush_history
+
+# How long a live position stays readable without new pings (seconds)
+LIVE_LOCATION_TIMEOUT = 60 * 60
+
+_pending = {}  # driver id -> (latitude, longitude, last_seen)
+_lock = threading.Lock()
+_flusher = None
+
+
+def _location_key(route_id):
+    return f"live_location:{route_id}"
+
+
+def record_location(assignment, latitude, longitude, driver_name=None, seen=None):
+    """
+    Stores a driver's newest position: in the cache for readers, and
+    in the buffer for the next database flush.
+    assignment is the dict from route_cache.get_driver_assignment().
+    """
+    seen = seen or timezone.now()
+    cache.set(_location_key(assignment['route_id']), {
+        'driver_id': assignment['driver_id'],
+        'driver_name': driver_name,
+        'latitude': float(latitude),
+        'longitude': float(longitude),
+        'last_seen': seen,
+    }, LIVE_LOCATION_TIMEOUT)
+
+    with _lock:
+        _pending[assignment['driver_id']] = (float(latitude), float(longitude), seen)
+        _start_flusher()
+
+
+def append_history(route_id, points):
+    """
+    Queues GPS history points (see history.append_points) and makes
+    sure the flusher thread is running to write them.
+    """
+    append_points(route_id, points)
+    with _lock:
+        _start_flusher()
+
+
+def get_live_location(route_id):
+    """The newest cached position for a route's bus, or None."""
+    return cache.get(_location_key(route_id))
+
+
+def flush_locations():
+    """Writes every buffered position in one bulk_update. Returns how many."""
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return 0
+
+    try:
+        DriverProfile.objects.bulk_update([
+            DriverProfile(id=driver_id, last_latitude=lat, last_longitude=lon, last_seen=seen)
+            for driver_id, (lat, lon, seen) in pending.items()
+        ], ['last_latitude', 'last_longitude', 'last_seen'])
+    except Exception:
+        # Put them back for the next try, unless a newer ping came in meanwhile
+        with _lock:
+            for driver_id, position in pending.items():
+                _pending.setdefault(driver_id, position)
+        raise
+    return len(pending)
+
+
+def _flush_forever():
+    """Body of the flusher thread (last-known positions and GPS history)."""
+    while True:
+        time.sleep(settings.LOCATION_FLUSH_SECONDS)
+        try:
+            flush_locations()
+        except Exception as e:
+            print(f"Error flushing driver locations: {e}")
+        try:
+            flush_history()
+        except Exception as e:
+            print(f"Error flushing location history: {e}")
+        finally:
+            # This thread keeps its own DB connection; don't hold it between flushes
+            connection.close()
+
+
+def _start_flusher():
+    """Starts the flusher thread on first use (call with _lock held)."""
+    global _flusher
+    if _flusher is None:
+        _flusher = threading.Thread(target=_flush_forever, name='location-flusher', daemon=True)
+        _flusher.start()
+
+
+# Don't drop the last few seconds of positions on a clean shutdown
+atexit.register(flush_locations)
+atexit.register(flush_history)
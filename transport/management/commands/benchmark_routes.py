@@ -0,0 +1,186 @@
+import io
+import json
+import math
+import time
+import tracemalloc
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F
+from django.test.utils import override_settings
+from django.utils import timezone
+from students.models import StudentProfile
+from transport.management.commands.optimize_routes import Command as OptimizeRoutes
+from transport.models import Route
+
+# --- CONFIGURATION ---
+COLLEGE_COORDS = settings.COLLEGE_COORDS
+LAYOUTS = ['uniform', 'clustered', 'corridor']
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+SERVICE_RADIUS_KM = 20      # How far out students live
+NEIGHBOURHOODS = 12         # Blobs in the clustered layout
+NEIGHBOURHOOD_KM = 1.5      # Spread of each blob
+CORRIDOR_WIDTH_KM = 1.0     # Spread either side of the corridor road
+KM_PER_DEGREE = 111.32
+
+
+def synthetic_students(layout, count, seed):
+    """
+    [lon, lat] homes for `count` students around the college.
+
+    uniform:   spread evenly over a disc of SERVICE_RADIUS_KM
+    clustered: a few dense neighbourhoods, each a Gaussian blob
+    corridor:  strung along one road through the college
+    """
+    rng = np.random.default_rng(seed)
+    if layout == 'uniform':
+        radius = SERVICE_RADIUS_KM * np.sqrt(rng.random(count))
+        angle = rng.uniform(0, 2 * math.pi, count)
+        east, north = radius * np.cos(angle), radius * np.sin(angle)
+    elif layout == 'clustered':
+        centers = rng.uniform(-SERVICE_RADIUS_KM, SERVICE_RADIUS_KM, (NEIGHBOURHOODS, 2)) * 0.7
+        home = rng.integers(NEIGHBOURHOODS, size=count)
+        east, north = (centers[home] + rng.normal(0, NEIGHBOURHOOD_KM, (count, 2))).T
+    elif layout == 'corridor':
+        along = rng.uniform(-SERVICE_RADIUS_KM, SERVICE_RADIUS_KM, count)
+        across = rng.normal(0, CORRIDOR_WIDTH_KM, count)
+        heading = math.radians(30)
+        east = along * math.cos(heading) - across * math.sin(heading)
+        north = along * math.sin(heading) + across * math.cos(heading)
+    else:
+        raise ValueError(f"Unknown layout: {layout}")
+
+    lat = COLLEGE_COORDS['latitude'] + north / KM_PER_DEGREE
+    lon = COLLEGE_COORDS['longitude'] + east / (KM_PER_DEGREE * math.cos(math.radians(COLLEGE_COORDS['latitude'])))
+    return np.column_stack([lon, lat])
+
+
+class Rollback(Exception):
+    """Raised to throw away a benchmark run's database changes."""
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks optimize_routes on synthetic students around the college, '
+        'using the offline travel-time model. Nothing is kept in the database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=DEFAULT_SIZES,
+            help='Student counts to try.'
+        )
+        parser.add_argument(
+            '--layouts',
+            nargs='+',
+            choices=LAYOUTS,
+            default=LAYOUTS,
+            help='Where the synthetic students live.'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed for the synthetic populations.'
+        )
+        parser.add_argument(
+            '--route-seconds',
+            type=float,
+            default=settings.ROUTE_SEARCH_SECONDS,
+            help='Passed through to optimize_routes.'
+        )
+        parser.add_argument(
+            '--output',
+            default='route_benchmark.json',
+            help='Where to write the results (JSON).'
+        )
+
+    def handle(self, *args, **options):
+        # Students already waiting, or routes with free seats, would be mixed into every run
+        if StudentProfile.objects.filter(route__isnull=True, latitude__isnull=False).exists():
+            raise CommandError("There are unassigned students in the database; run this on an empty one.")
+        if Route.objects.annotate(student_count=Count('students')).filter(student_count__lt=F('capacity')).exists():
+            raise CommandError("Some routes have free seats; run this on an empty database.")
+
+        results = []
+        for layout in options['layouts']:
+            for size in options['sizes']:
+                self.stdout.write(f"Benchmarking {layout} layout with {size} students...")
+                result = self.run_scenario(layout, size, options)
+                results.append(result)
+                self.stdout.write(
+                    f"  {result['wall_seconds']:.1f}s, peak {result['peak_memory_mb']:.1f} MB, "
+                    f"{result['outbound_calls']} outbound call(s), {result['routes']} route(s), "
+                    f"fleet ~{result['fleet_duration_seconds'] / 3600:.1f} h"
+                )
+
+        report = {
+            'generated_at': timezone.now().isoformat(),
+            'seed': options['seed'],
+            'route_seconds': options['route_seconds'],
+            'vehicle_fleet': settings.VEHICLE_FLEET,
+            'max_route_seconds': settings.MAX_ROUTE_SECONDS,
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}."))
+
+    def run_scenario(self, layout, size, options):
+        """
+        Creates the students, runs optimize_routes once and measures
+        it, then rolls everything back.
+        """
+        locs = synthetic_students(layout, size, options['seed'])
+        optimizer = OptimizeRoutes(stdout=io.StringIO() if options['verbosity'] < 2 else self.stdout)
+
+        try:
+            with transaction.atomic():
+                self.create_students(layout, locs)
+
+                tracemalloc.start()
+                started = time.perf_counter()
+                with override_settings(TRAVEL_TIME_PROVIDER='local'):
+                    call_command(optimizer, route_seconds=options['route_seconds'])
+                wall_seconds = time.perf_counter() - started
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                metrics = optimizer.plan.metrics()
+                waiting = StudentProfile.objects.filter(route__isnull=True).count()
+                raise Rollback
+        except Rollback:
+            pass
+
+        return {
+            'layout': layout,
+            'students': size,
+            'wall_seconds': round(wall_seconds, 3),
+            'peak_memory_mb': round(peak / 2 ** 20, 2),
+            'outbound_calls': optimizer.provider.calls,
+            'routes': metrics['routes'],
+            'waiting': waiting,
+            'fleet_duration_seconds': round(metrics['total_seconds'], 1),
+            'longest_route_seconds': round(metrics['longest_seconds'], 1),
+        }
+
+    def create_students(self, layout, locs):
+        """Bulk-creates one user + StudentProfile per synthetic home."""
+        users = User.objects.bulk_create([
+            User(username=f"bench-{layout}-{i}", password='!')
+            for i in range(len(locs))
+        ], batch_size=1000)
+        if users and users[0].pk is None:
+            # Backends that don't return ids from bulk inserts
+            users = list(User.objects.filter(username__startswith=f"bench-{layout}-").order_by('id'))
+        StudentProfile.objects.bulk_create([
+            StudentProfile(user=user, student_id=f"B{i}", longitude=float(lon), latitude=float(lat))
+            for i, (user, (lon, lat)) in enumerate(zip(users, locs))
+        ], batch_size=1000)
@@ -1,82 +1,206 @@
-import requests
 from django.conf import settings
 from django.db import transaction
 from django.core.management.base import BaseCommand
 from students.models import StudentProfile
 from transport.models import Route
-from django.db.models import Count
+from transport import solver
+from transport.utils import route_letters
+from transport.matrix import get_matrix_provider, DurationTable
+from transport.plan import RoutePlan, UNASSIGNED
+from django.db.models import Count, F
 
-# --- CONFIGURATION (Unchanged) ---
-BUS_CAPACITY = 5 
-ORS_API_KEY = settings.ORS_API_KEY
+# --- CONFIGURATION ---
 COLLEGE_COORDS = settings.COLLEGE_COORDS
-ORS_MATRIX_ENDPOINT = 'https://api.openrouteservice.org/v2/matrix/driving-car'
 
 class Command(BaseCommand):
     help = 'Optimizes routes. First fills empty slots, then creates new routes.'
 
-    # --- HELPER 1: Get Driving Times (Unchanged) ---
-    def get_driving_times(self, college_loc, student_locs):
-        try:
-            locations = [college_loc] + student_locs
-            body = {"locations": locations, "metrics": ["duration"], "sources": ["0"]}
-            headers = {'Authorization': ORS_API_KEY, 'Content-Type': 'application/json'}
-            
-            self.stdout.write(self.style.NOTICE("...Calling ORS API for driving times..."))
-            res = requests.post(ORS_MATRIX_ENDPOINT, json=body, headers=headers)
-            res.raise_for_status()
-            data = res.json()
-            durations = data['durations'][0][1:] 
-            return durations
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f"ORS API Error: {e}"))
-            return None
-
-    # --- HELPER 2: Re-sorts a single route (NEW) ---
-    @transaction.atomic
-    def re_sort_route(self, route):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Re-sort every changed route from scratch instead of slotting new students in.'
+        )
+        parser.add_argument(
+            '--route-seconds',
+            type=float,
+            default=settings.ROUTE_SEARCH_SECONDS,
+            help='Time budget (seconds) for improving each route\'s pickup order.'
+        )
+        parser.add_argument(
+            '--starts',
+            type=int,
+            default=1,
+            help='Number of randomized starts to try when building new routes (best one wins).'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='First seed; starts use seeds SEED, SEED+1, ... so runs are reproducible.'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Worker processes for --starts (default: one per CPU core).'
+        )
+        parser.add_argument(
+            '--time-budget',
+            type=float,
+            default=None,
+            help='Wall-clock limit (seconds) for the multi-start search.'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Work out the plan and print what would change, without saving any assignments.'
+        )
+
+    # --- HELPER 1: Re-sorts a single route ---
+    def re_sort_route(self, route, students_on_route, unlocated=()):
         """
-        Takes a route, gets all its students, re-calculates their
-        driving times, and updates their pickup_order.
+        Works out a new pickup_order for every student on a route from
+        the full stop-to-stop driving times (farthest stop first, then
+        polished with 2-opt/Or-opt) and adds it to the plan. Students
+        without a location (unlocated) stay at the end.
         """
         self.stdout.write(f"Re-sorting route: {route.name}...")
-        
-        students_on_route = list(StudentProfile.objects.filter(route=route))
         if not students_on_route:
             return # Should not happen, but good to check
 
-        # 1. Get locations
+        # 1. Get locations (college last) and the driving times between them
         college_loc = [COLLEGE_COORDS['longitude'], COLLEGE_COORDS['latitude']]
-        student_locs = [[s.longitude, s.latitude] for s in students_on_route]
+        times = self.table.matrix([[s.longitude, s.latitude] for s in students_on_route] + [college_loc])
+        college = len(students_on_route)
 
-        # 2. Get driving times
-        driving_times = self.get_driving_times(college_loc, student_locs)
-        if not driving_times:
-            self.stdout.write(self.style.ERROR(f"Could not re-sort {route.name}. Skipping."))
-            return
+        # 2. Work out the order
+        order = solver.plan_pickup_order(times, range(college), college, self.route_seconds)
 
-        # 3. Pair students with times
-        student_time_pairs = list(zip(students_on_route, driving_times))
-        
-        # 4. Sort by time (farthest first)
-        student_time_pairs.sort(key=lambda x: x[1], reverse=True)
-        
-        # 5. Update pickup_order
-        for index, (student, time) in enumerate(student_time_pairs):
-            order = index + 1
-            student.pickup_order = order
-            student.driving_time_seconds = time
-            student.save()
-            
-        self.stdout.write(f"Successfully re-sorted {route.name}.")
+        # 3. Add it to the plan
+        planned = self.plan.add_route(
+            route.name, [s.id for s in students_on_route], times, order, college,
+            route_id=route.id, unlocated_ids=[s.id for s in unlocated]
+        )
+        self.stdout.write(
+            f"Re-sorted {route.name} (total route duration ~{planned.duration / 60:.0f} min)."
+        )
+
+    # --- HELPER 2: Slot new students into an existing order ---
+    def insert_into_route(self, route, current_students, new_students, unlocated=()):
+        """
+        Places each new student at the cheapest position in the route's
+        existing pickup_order. If the result is noticeably slower (more
+        than ROUTE_REOPTIMIZE_TOLERANCE) than simply driving farthest
+        stop first, the route is re-sorted from scratch instead.
+        Students without a location (unlocated) stay at the end.
+        """
+        college_loc = [COLLEGE_COORDS['longitude'], COLLEGE_COORDS['latitude']]
+        sequence = sorted(
+            current_students,
+            key=lambda s: (s.pickup_order is None, s.pickup_order or 0, s.id)
+        )
+        everyone = sequence + new_students
+        times = self.table.matrix([[s.longitude, s.latitude] for s in everyone] + [college_loc])
+        college = len(everyone)
+
+        # 1. Insert the new students one by one
+        order = list(range(len(sequence)))
+        for new_index in range(len(sequence), len(everyone)):
+            _, position = solver.best_insertion(times, order, new_index, college)
+            order.insert(position, new_index)
+
+        # 2. Cheap sanity check against the farthest-first baseline
+        baseline = solver.farthest_first_order(times, range(len(everyone)), college)
+        incremental_time = solver.sequence_duration(times, order, college)
+        baseline_time = solver.sequence_duration(times, baseline, college)
+        resorted = incremental_time > baseline_time * (1 + settings.ROUTE_REOPTIMIZE_TOLERANCE)
+        if resorted:
+            self.stdout.write(
+                f"{route.name}: slotting in would take {incremental_time / 60:.0f} min vs "
+                f"{baseline_time / 60:.0f} min farthest-first. Re-sorting fully..."
+            )
+            order = solver.plan_pickup_order(times, range(len(everyone)), college, self.route_seconds)
+
+        # 3. Add it to the plan (only rows that move get written later)
+        planned = self.plan.add_route(
+            route.name, [s.id for s in everyone], times, order, college,
+            route_id=route.id, unlocated_ids=[s.id for s in unlocated]
+        )
+        if resorted:
+            summary = f"Re-sorted {route.name} with {len(new_students)} new student(s)"
+        else:
+            summary = f"Slotted {len(new_students)} student(s) into {route.name}"
+        self.stdout.write(f"{summary} (~{planned.duration / 60:.0f} min).")
+
+    # --- HELPER 3: Group the waitlist into new routes ---
+    def build_clusters(self, college_loc, student_locs, capacities, options):
+        """
+        Splits the waitlist into new routes. With --starts > 1 several
+        seeded starts run in parallel and the fastest plan is kept.
+        """
+        seeds = range(options['seed'], options['seed'] + max(1, options['starts']))
+        if len(seeds) == 1:
+            return solver.seeded_clusters(student_locs, capacities, seeds[0])
+
+        self.stdout.write(self.style.NOTICE(
+            f"...Trying {len(seeds)} starts (seeds {seeds[0]}-{seeds[-1]})..."
+        ))
+        best, finished = solver.multi_start_clusters(
+            college_loc, student_locs, capacities, seeds,
+            workers=options['workers'], time_budget=options['time_budget']
+        )
+        if finished < len(seeds):
+            self.stdout.write(self.style.WARNING(
+                f"Only {finished} of {len(seeds)} starts finished within the time budget."
+            ))
+        self.stdout.write(
+            f"Best start: seed {best['seed']} (~{best['duration'] / 60:.0f} min estimated driving)."
+        )
+        return best['clusters']
+
+    # --- HELPER 4: Vehicles left in the fleet ---
+    def available_fleet(self):
+        """
+        settings.VEHICLE_FLEET minus the vehicles already running a
+        route, as {seats: vehicles left (None for no limit)}.
+        """
+        in_use = dict(Route.objects.values_list('capacity').annotate(count=Count('id')))
+        return {
+            seats: None if count is None else max(count - in_use.get(seats, 0), 0)
+            for seats, count in settings.VEHICLE_FLEET.items()
+        }
+
+    # --- HELPER 5: Route names ---
+    def new_route_names(self, count):
+        """
+        Next free names in the "Route A" ... "Route Z", "Route AA",
+        "Route AB" ... sequence, skipping names already in use.
+        """
+        taken = set(Route.objects.values_list('name', flat=True))
+        names = []
+        index = 0
+        while len(names) < count:
+            name = f"Route {route_letters(index)}"
+            if name not in taken:
+                names.append(name)
+            index += 1
+        return names
 
     # --- MAIN FUNCTION (New Logic) ---
     @transaction.atomic
     def handle(self, *args, **options):
+        # One provider for the whole run so its cache/call counters add up
+        self.provider = get_matrix_provider()
+        self.table = DurationTable(self.provider, log=self.stdout.write)
+        self.route_seconds = options['route_seconds']
+        self.plan = RoutePlan()
+
         # Get all unassigned students
         unassigned_students = list(StudentProfile.objects.filter(
             route__isnull=True,
-            latitude__isnull=False
+            latitude__isnull=False,
+            longitude__isnull=False
         ))
         
         if not unassigned_students:
@@ -84,93 +208,198 @@ class Command(BaseCommand):
             return
             
         self.stdout.write(f"Found {len(unassigned_students)} unassigned student(s).")
+        college_loc = [COLLEGE_COORDS['longitude'], COLLEGE_COORDS['latitude']]
 
         # --- STAGE 1: FILL EMPTY SLOTS ---
         self.stdout.write("--- Stage 1: Filling empty slots ---")
         
-        # Find routes with fewer than 5 students
-        routes_with_slots = Route.objects.annotate(
+        # Find routes with fewer students than seats
+        routes_with_slots = list(Route.objects.annotate(
             student_count=Count('students')
         ).filter(
-            student_count__lt=BUS_CAPACITY
-        ).order_by('student_count') # Start with the least full routes first
+            student_count__lt=F('capacity')
+        ).order_by('student_count')) # Start with the least full routes first
 
+        touched_routes = []
         if not routes_with_slots:
             self.stdout.write("No existing routes have empty slots.")
         else:
+            # Current stops on each route, in pickup order
+            route_stops = []
             for route in routes_with_slots:
-                # Get the number of empty slots
-                current_count = route.student_count
-                slots_to_fill = BUS_CAPACITY - current_count
-                
-                # Get students from the waitlist to fill these slots
-                students_to_add = unassigned_students[:slots_to_fill]
-                
-                if not students_to_add:
-                    self.stdout.write("No more unassigned students to fill slots.")
-                    break # Stop looping through routes if waitlist is empty
+                stops = route.students.filter(latitude__isnull=False, longitude__isnull=False).order_by('pickup_order')
+                route_stops.append([[s.longitude, s.latitude] for s in stops])
 
+            # Let the solver pick which waitlisted students go where,
+            # choosing the seats that add the least driving time to the fleet
+            assignments = solver.assign_to_routes(
+                college_loc,
+                route_stops,
+                [route.capacity - route.student_count for route in routes_with_slots],
+                [[s.longitude, s.latitude] for s in unassigned_students]
+            )
+
+            students_by_route = {}
+            for student_index, route_index in assignments:
+                students_by_route.setdefault(route_index, []).append(unassigned_students[student_index])
+
+            for route_index, students_to_add in students_by_route.items():
+                route = routes_with_slots[route_index]
                 self.stdout.write(f"Adding {len(students_to_add)} student(s) to {route.name}...")
+                # Planned in Stage 3 once driving times are in, saved in Stage 4
+                touched_routes.append((route, students_to_add))
 
-                # Assign students to the route
-                for student in students_to_add:
-                    student.route = route
-                    student.save()
-                
-                # Re-sort the *entire* route with the new student(s)
-                self.re_sort_route(route)
-                
-                # Remove the students we just added from the waitlist
-                unassigned_students = unassigned_students[len(students_to_add):]
+            # Remove the students we just added from the waitlist
+            assigned = {student_index for student_index, _ in assignments}
+            unassigned_students = [
+                s for index, s in enumerate(unassigned_students) if index not in assigned
+            ]
 
         # --- STAGE 2: CREATE NEW ROUTES ---
         self.stdout.write("--- Stage 2: Checking for new routes ---")
         
         num_remaining = len(unassigned_students)
+        fleet = {seats: count for seats, count in self.available_fleet().items() if count != 0}
+        smallest_vehicle = min(fleet, default=None)
+        new_route_groups = []
+        new_route_capacities = []
 
         if num_remaining == 0:
             self.stdout.write(self.style.SUCCESS(
                 "All unassigned students were added to existing routes. No new routes needed."
             ))
-            return # Exit the script successfully
-        # --- END FIX ---
-            
         # If we are here, it means there are still students left over.
         # Now we check if there are enough for a *new* route.
-        if num_remaining < BUS_CAPACITY:
+        elif smallest_vehicle is None:
+            self.stdout.write(self.style.WARNING(
+                f"Every vehicle in the fleet is in use. {num_remaining} student(s) will keep waiting."
+            ))
+        elif num_remaining < smallest_vehicle:
             self.stdout.write(self.style.WARNING(
                 f"Waiting for more students. "
-                f"Need {BUS_CAPACITY}, currently have {num_remaining}."
+                f"Need {smallest_vehicle}, currently have {num_remaining}."
             ))
+        else:
+            # We have enough to create at least one new route.
+            # Seat as many students as we can in full vehicles, trading
+            # fewer vehicles against driving time and the longest route.
+            student_locs = [[s.longitude, s.latitude] for s in unassigned_students]
+            chosen = solver.choose_fleet(
+                college_loc, student_locs, fleet,
+                settings.MAX_ROUTE_SECONDS, settings.VEHICLE_COST_SECONDS, seed=options['seed']
+            )
+            new_route_capacities = chosen['capacities']
+            if options['starts'] > 1:
+                clusters = self.build_clusters(college_loc, student_locs, new_route_capacities, options)
+            else:
+                clusters = chosen['clusters']  # The plan choose_fleet() already made with this seed
+            new_route_groups = [[unassigned_students[i] for i in cluster] for cluster in clusters]
+            if chosen['longest'] > settings.MAX_ROUTE_SECONDS:
+                self.stdout.write(self.style.WARNING(
+                    f"The fleet can't keep every new route under {settings.MAX_ROUTE_SECONDS / 60:.0f} min "
+                    f"(longest ~{chosen['longest'] / 60:.0f} min estimated)."
+                ))
+
+            vehicles = ', '.join(
+                f"{new_route_capacities.count(seats)} x {seats}-seat"
+                for seats in sorted(set(new_route_capacities), reverse=True)
+            )
+            self.stdout.write(
+                f"{num_remaining} students remain. Creating {len(new_route_capacities)} new route(s) "
+                f"({vehicles}); {num_remaining - sum(new_route_capacities)} student(s) will keep waiting."
+            )
+
+        # --- STAGE 3: SORT EVERY CHANGED ROUTE ---
+        # Collect every stop we are about to sort, then get all their
+        # driving times in one batched request instead of one per route
+        # (students without a location can't be sorted; they keep riding at the end)
+        students_on_touched_routes, unlocated_on_touched_routes = {}, {}
+        for route, _ in touched_routes:
+            students = list(StudentProfile.objects.filter(route=route).order_by('pickup_order', 'id'))
+            students_on_touched_routes[route.id] = [
+                s for s in students if s.latitude is not None and s.longitude is not None
+            ]
+            unlocated_on_touched_routes[route.id] = [
+                s for s in students if s.latitude is None or s.longitude is None
+            ]
+        groups = [
+            [college_loc] + [[s.longitude, s.latitude] for s in students_on_touched_routes[route.id] + new]
+            for route, new in touched_routes
+        ]
+        for students in new_route_groups:
+            groups.append([college_loc] + [[s.longitude, s.latitude] for s in students])
+        if groups:
+            self.stdout.write(self.style.NOTICE(
+                f"...Getting driving times for {sum(len(g) - 1 for g in groups)} stop(s) (cache first, then ORS)..."
+            ))
+            self.table.prefetch(groups)
+
+        for route, new_students in touched_routes:
+            current_students = students_on_touched_routes[route.id]
+            unlocated = unlocated_on_touched_routes[route.id]
+            if options['full']:
+                self.re_sort_route(route, current_students + new_students, unlocated)
+            else:
+                self.insert_into_route(route, current_students, new_students, unlocated)
+
+        route_names = self.new_route_names(len(new_route_groups))
+        for route_name, students_to_assign, capacity in zip(route_names, new_route_groups, new_route_capacities):
+            times = self.table.matrix([[s.longitude, s.latitude] for s in students_to_assign] + [college_loc])
+            college = len(students_to_assign)
+            order = solver.plan_pickup_order(times, range(college), college, self.route_seconds)
+            planned = self.plan.add_route(
+                route_name, [s.id for s in students_to_assign], times, order, college, capacity=capacity
+            )
+            self.stdout.write(
+                f"Planned new route {route_name} ({capacity} seats, "
+                f"total route duration ~{planned.duration / 60:.0f} min)."
+            )
+
+        # --- STAGE 4: SAVE (OR JUST SHOW) THE PLAN ---
+        # Where every planned student is right now
+        current = {s.id: UNASSIGNED for s in unassigned_students}
+        for route, new_students in touched_routes:
+            for student in students_on_touched_routes[route.id] + unlocated_on_touched_routes[route.id]:
+                current[student.id] = (route.name, student.pickup_order, student.driving_time_seconds)
+            for student in new_students:
+                current[student.id] = UNASSIGNED
+        self.report_plan(current, show_diff=options['dry_run'])
+
+        self.report_provider_usage()
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING("Dry run: no assignments were saved."))
             return
-            
-        # We have enough to create at least one new route
-        self.stdout.write(f"{num_remaining} students remain. Creating new route(s)...")
-        
-        students_to_assign = unassigned_students[:BUS_CAPACITY]
-        
-        # (This is the same logic as our old script)
-        college_loc = [COLLEGE_COORDS['longitude'], COLLEGE_COORDS['latitude']]
-        student_locs = [[s.longitude, s.latitude] for s in students_to_assign]
-        
-        driving_times = self.get_driving_times(college_loc, student_locs)
-        
-        if driving_times:
-            student_time_pairs = list(zip(students_to_assign, driving_times))
-            student_time_pairs.sort(key=lambda x: x[1], reverse=True)
-            
-            route_name = f"Route {chr(65 + Route.objects.count())}"
-            new_route = Route.objects.create(name=route_name)
-            
-            self.stdout.write(f"Created {new_route.name}. Assigning students...")
-            
-            for index, (student, time) in enumerate(student_time_pairs):
-                order = index + 1
-                student.route = new_route
-                student.pickup_order = order
-                student.driving_time_seconds = time
-                student.save()
-            
-            self.stdout.write(self.style.SUCCESS(f"New route {new_route.name} created."))
-        
-        self.stdout.write(self.style.SUCCESS(f"Optimization complete."))
\ No newline at end of file
+
+        written = self.plan.apply(current)
+        self.stdout.write(self.style.SUCCESS(
+            f"Optimization complete. Saved {written} student(s) across {len(self.plan.routes)} route(s)."
+        ))
+
+    def report_plan(self, current, show_diff=False):
+        """Prints the plan's metrics (and, for dry runs, the full diff)."""
+        if show_diff:
+            students = StudentProfile.objects.filter(id__in=current).values_list('id', 'student_id')
+            for line in self.plan.diff(current, labels=dict(students)):
+                self.stdout.write(line)
+
+        metrics = self.plan.metrics(current)
+        if metrics['routes']:
+            self.stdout.write(
+                f"Plan: {metrics['routes']} route(s) ({metrics['new_routes']} new, {metrics['new_seats']} new seat(s)), "
+                f"{metrics['newly_assigned']} student(s) assigned, {metrics['reordered']} moved. "
+                f"Total driving time ~{metrics['total_seconds'] / 60:.0f} min, "
+                f"longest route ~{metrics['longest_seconds'] / 60:.0f} min."
+            )
+
+    def report_provider_usage(self):
+        """Prints how many driving times came from the cache vs. ORS (vs. estimates)."""
+        provider = self.provider
+        if hasattr(provider, 'hits'):
+            self.stdout.write(
+                f"Driving times: {provider.hits} from cache, {provider.misses} fetched "
+                f"in {provider.calls} ORS call(s)."
+            )
+        if self.table.failed:
+            self.stdout.write(self.style.WARNING(
+                "ORS failed during this run; the remaining driving times are offline estimates."
+            ))
\ No newline at end of file
@@ -0,0 +1,406 @@
+# transport/matrix.py
+"""
+Travel-time matrix providers.
+
+Both providers answer the same question as the ORS matrix API:
+given a list of [lon, lat] locations (and optionally which of them
+are sources and destinations), how long does it take to drive from
+each source to each destination?
+
+    provider = get_matrix_provider()
+    result = provider.matrix(locations, sources=[0])
+    result['durations']  # seconds, rows = sources, cols = destinations
+    result['distances']  # meters, same shape
+
+Results are NumPy arrays. Pairs ORS cannot route come back as NaN.
+"""
+from datetime import timedelta
+
+import numpy as np
+import requests
+from django.conf import settings
+from django.db.models import Subquery
+from django.utils import timezone
+
+from .models import TravelTimeCache
+from .utils import haversine_matrix
+
+ORS_MATRIX_ENDPOINT = 'https://api.openrouteservice.org/v2/matrix/driving-car'
+
+
+def _pick(locations, indices):
+    """Returns the rows of `locations` named by `indices` (all if None)."""
+    if indices is None:
+        return locations
+    return locations[np.asarray(indices, dtype=int)]
+
+
+def travel_seconds(road_km):
+    """
+    Turns road distances (km, any array shape) into driving times
+    using settings.AVERAGE_SPEED_MODEL.
+    """
+    road_km = np.asarray(road_km, dtype=float)
+
+    # Walk through the stretches, building the time it takes
+    # to reach the end of each one
+    breakpoints, times = [0.0], [0.0]
+    for length, speed in settings.AVERAGE_SPEED_MODEL[:-1]:
+        breakpoints.append(breakpoints[-1] + length)
+        times.append(times[-1] + length / speed * 3600)
+    final_speed = settings.AVERAGE_SPEED_MODEL[-1][1]
+
+    within = np.interp(np.minimum(road_km, breakpoints[-1]), breakpoints, times)
+    beyond = np.maximum(road_km - breakpoints[-1], 0) / final_speed * 3600
+    return within + beyond
+
+
+def estimate_durations(origins, destinations):
+    """
+    Estimated driving time in seconds from every origin to every
+    destination. Both arguments are sequences of [lon, lat].
+    """
+    origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+    destinations = np.asarray(destinations, dtype=float).reshape(-1, 2)
+    km = haversine_matrix(origins[:, 0], origins[:, 1], destinations[:, 0], destinations[:, 1])
+    return travel_seconds(km * settings.ROAD_DETOUR_FACTOR)
+
+
+class LocalMatrixProvider:
+    """
+    Offline stand-in for the ORS matrix API.
+    Uses straight-line distance, a road detour factor and the
+    average-speed model from settings. Never touches the network.
+    """
+    name = 'local'
+
+    def __init__(self):
+        self.calls = 0  # Requests that would have gone to ORS
+
+    def matrix(self, locations, sources=None, destinations=None):
+        self.calls += 1
+        locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+        origins = _pick(locations, sources)
+        targets = _pick(locations, destinations)
+
+        km = haversine_matrix(origins[:, 0], origins[:, 1], targets[:, 0], targets[:, 1])
+        road_km = km * settings.ROAD_DETOUR_FACTOR
+        return {
+            'durations': travel_seconds(road_km),
+            'distances': road_km * 1000,
+        }
+
+
+class ORSMatrixProvider:
+    """
+    Asks the OpenRouteService matrix API. Raises on any
+    network or API error so callers can fall back.
+    """
+    name = 'ors'
+
+    def __init__(self, api_key=None, timeout=10):
+        self.api_key = api_key or settings.ORS_API_KEY
+        self.timeout = timeout
+        self.calls = 0  # Outbound requests made by this provider
+
+    def matrix(self, locations, sources=None, destinations=None):
+        locations = [[float(lon), float(lat)] for lon, lat in locations]
+        body = {"locations": locations, "metrics": ["duration", "distance"]}
+        if sources is not None:
+            body["sources"] = [str(i) for i in sources]
+        if destinations is not None:
+            body["destinations"] = [str(i) for i in destinations]
+        headers = {'Authorization': self.api_key, 'Content-Type': 'application/json'}
+
+        self.calls += 1
+        res = requests.post(ORS_MATRIX_ENDPOINT, json=body, headers=headers, timeout=self.timeout)
+        res.raise_for_status()
+        data = res.json()
+        # None (unroutable) becomes NaN
+        return {
+            'durations': np.array(data['durations'], dtype=float),
+            'distances': np.array(data['distances'], dtype=float),
+        }
+
+
+def quantize(locations):
+    """
+    Turns [lon, lat] rows into integer cache keys. Coordinates are
+    rounded to settings.TRAVEL_TIME_CACHE_PRECISION decimal places, so
+    a student who moves a few meters still hits the same entry.
+    """
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    scale = 10 ** settings.TRAVEL_TIME_CACHE_PRECISION
+    lons = np.rint(locations[:, 0] * scale).astype(np.int64) + 180 * scale
+    lats = np.rint(locations[:, 1] * scale).astype(np.int64) + 90 * scale
+    return lats * (360 * scale + 1) + lons
+
+
+def prune_travel_time_cache():
+    """
+    Drops expired entries, then the least recently used ones
+    until the table is back under TRAVEL_TIME_CACHE_MAX_ENTRIES.
+    """
+    cutoff = timezone.now() - timedelta(days=settings.TRAVEL_TIME_CACHE_TTL_DAYS)
+    TravelTimeCache.objects.filter(fetched_at__lt=cutoff).delete()
+
+    extra = TravelTimeCache.objects.count() - settings.TRAVEL_TIME_CACHE_MAX_ENTRIES
+    if extra > 0:
+        oldest = TravelTimeCache.objects.order_by('last_used').values('id')[:extra]
+        TravelTimeCache.objects.filter(id__in=Subquery(oldest)).delete()
+
+
+class CachedMatrixProvider:
+    """
+    Wraps another provider (normally ORS) with the TravelTimeCache
+    table. Pairs we already know are answered from the database;
+    only the missing ones are sent to the wrapped provider.
+    hits counts pairs answered from the cache, misses the pairs the
+    wrapped provider actually returned.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.name = provider.name
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def calls(self):
+        return getattr(self.provider, 'calls', 0)
+
+    def _lookup(self, origin_keys, destination_keys):
+        """Returns {(origin, destination): (duration, distance)} for fresh entries."""
+        cutoff = timezone.now() - timedelta(days=settings.TRAVEL_TIME_CACHE_TTL_DAYS)
+        entries = TravelTimeCache.objects.filter(
+            origin__in=set(origin_keys.tolist()),
+            destination__in=set(destination_keys.tolist()),
+            fetched_at__gte=cutoff
+        )
+        found = {
+            (origin, destination): (duration, distance)
+            for origin, destination, duration, distance
+            in entries.values_list('origin', 'destination', 'duration', 'distance')
+        }
+        if found:
+            entries.update(last_used=timezone.now())
+        return found
+
+    def remember(self, origins, destinations, durations, distances=None):
+        """
+        Stores driving times for origins[i] -> destinations[i].
+        Useful for results that came from somewhere other than the
+        matrix API (e.g. the segments of an ORS directions call).
+        """
+        if distances is None:
+            distances = [None] * len(durations)
+        rows = {}
+        for origin, destination, duration, distance in zip(
+            quantize(origins).tolist(), quantize(destinations).tolist(), durations, distances
+        ):
+            if duration is None or np.isnan(duration):
+                continue  # Unroutable, ask again next time
+            if distance is not None and np.isnan(distance):
+                distance = None
+            rows[(origin, destination)] = TravelTimeCache(
+                origin=origin, destination=destination,
+                duration=float(duration),
+                distance=None if distance is None else float(distance),
+            )
+        if not rows:
+            return
+        TravelTimeCache.objects.bulk_create(
+            rows.values(),
+            batch_size=500,
+            update_conflicts=True,
+            unique_fields=['origin', 'destination'],
+            update_fields=['duration', 'distance', 'fetched_at', 'last_used'],
+        )
+        prune_travel_time_cache()
+
+    def matrix(self, locations, sources=None, destinations=None):
+        locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+        source_index = np.arange(len(locations)) if sources is None else np.asarray(sources, dtype=int)
+        destination_index = np.arange(len(locations)) if destinations is None else np.asarray(destinations, dtype=int)
+
+        keys = quantize(locations)
+        source_keys, destination_keys = keys[source_index], keys[destination_index]
+
+        # 1. Fill in everything the cache already knows
+        durations = np.full((len(source_index), len(destination_index)), np.nan)
+        distances = np.full(durations.shape, np.nan)
+        cached = self._lookup(source_keys, destination_keys)
+        for i, origin in enumerate(source_keys.tolist()):
+            for j, destination in enumerate(destination_keys.tolist()):
+                entry = cached.get((origin, destination))
+                if entry is not None:
+                    durations[i, j] = entry[0]
+                    distances[i, j] = np.nan if entry[1] is None else entry[1]
+
+        missing = np.isnan(durations)
+        self.hits += int((~missing).sum())
+        if not missing.any():
+            return {'durations': durations, 'distances': distances}
+
+        # 2. Ask the real provider only for rows/columns that have gaps
+        rows = np.flatnonzero(missing.any(axis=1))
+        cols = np.flatnonzero(missing.any(axis=0))
+        needed = np.unique(np.concatenate([source_index[rows], destination_index[cols]]))
+        position = {int(index): i for i, index in enumerate(needed)}
+        fresh = self.provider.matrix(
+            locations[needed],
+            sources=[position[int(i)] for i in source_index[rows]],
+            destinations=[position[int(i)] for i in destination_index[cols]],
+        )
+        self.misses += int(missing.sum())
+        durations[np.ix_(rows, cols)] = fresh['durations']
+        distances[np.ix_(rows, cols)] = fresh['distances']
+
+        # 3. Save the new pairs for next time
+        origin_rows, destination_cols = np.meshgrid(rows, cols, indexing='ij')
+        self.remember(
+            locations[source_index[origin_rows.ravel()]],
+            locations[destination_index[destination_cols.ravel()]],
+            fresh['durations'].ravel(),
+            fresh['distances'].ravel(),
+        )
+        return {'durations': durations, 'distances': distances}
+
+    def pairs(self, origins, destinations):
+        """
+        Driving time for origins[i] -> destinations[i] only (not the
+        full matrix). Returns a NumPy array of seconds.
+        """
+        origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+        destinations = np.asarray(destinations, dtype=float).reshape(-1, 2)
+        result = np.full(len(origins), np.nan)
+        if not len(origins):
+            return result
+
+        cached = self._lookup(quantize(origins), quantize(destinations))
+        for i, pair in enumerate(zip(quantize(origins).tolist(), quantize(destinations).tolist())):
+            if pair in cached:
+                result[i] = cached[pair][0]
+
+        missing = np.flatnonzero(np.isnan(result))
+        self.hits += len(origins) - len(missing)
+        if len(missing):
+            locations = np.concatenate([origins[missing], destinations[missing]])
+            fresh = self.provider.matrix(
+                locations,
+                sources=list(range(len(missing))),
+                destinations=list(range(len(missing), 2 * len(missing))),
+            )
+            self.misses += len(missing)
+            result[missing] = np.diagonal(fresh['durations'])
+            self.remember(
+                origins[missing], destinations[missing],
+                np.diagonal(fresh['durations']), np.diagonal(fresh['distances'])
+            )
+        return result
+
+
+class DurationTable:
+    """
+    Driving times for one optimization run.
+
+    Collect every group of points you will need first, then call
+    prefetch() once: the points are packed into as few provider calls
+    as settings.ORS_MATRIX_MAX_ELEMENTS allows. Later lookups are
+    answered from memory. If the provider fails, the table switches to
+    the offline estimate for the rest of the run.
+    """
+
+    def __init__(self, provider, max_elements=None, log=print):
+        self.provider = provider
+        self.max_elements = max_elements or settings.ORS_MATRIX_MAX_ELEMENTS
+        self.log = log
+        self.failed = False
+        self.known = {}  # (origin key, destination key) -> seconds
+        self.fallback = LocalMatrixProvider()
+
+    def _fetch(self, locations, sources=None, destinations=None):
+        """One provider call, remembered in self.known."""
+        locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+        estimates = self.fallback.matrix(locations, sources, destinations)['durations']
+        durations = estimates
+
+        if not self.failed and self.provider is not self.fallback:
+            try:
+                durations = self.provider.matrix(locations, sources, destinations)['durations']
+                # Unroutable pairs (NaN) get the estimate instead
+                durations = np.where(np.isnan(durations), estimates, durations)
+            except Exception as e:
+                self.log(f"Travel time provider error: {e}")
+                self.log("...Using estimated driving times for the rest of this run...")
+                self.failed = True
+
+        keys = quantize(locations)
+        source_keys = keys if sources is None else keys[np.asarray(sources, dtype=int)]
+        destination_keys = keys if destinations is None else keys[np.asarray(destinations, dtype=int)]
+        for i, origin in enumerate(source_keys.tolist()):
+            for j, destination in enumerate(destination_keys.tolist()):
+                self.known[(origin, destination)] = float(durations[i, j])
+
+    def prefetch(self, groups):
+        """
+        Loads every pairwise driving time inside each group of points
+        (e.g. one route's stops plus the college). Small groups are
+        packed together so each provider call stays under max_elements.
+        """
+        chunk = {}
+        for group in groups:
+            group_points = {key: point for point, key in zip(group, quantize(group).tolist())}
+            if all((a, b) in self.known for a in group_points for b in group_points):
+                continue
+            merged = {**chunk, **group_points}
+            if chunk and len(merged) ** 2 > self.max_elements:
+                self._fetch_all_pairs(list(chunk.values()))
+                merged = group_points
+            chunk = merged
+        if chunk:
+            self._fetch_all_pairs(list(chunk.values()))
+
+    def _fetch_all_pairs(self, points):
+        """Full matrix for points, split into tiles if it is too big for one call."""
+        rows = max(self.max_elements // len(points), 1)
+        cols = min(len(points), self.max_elements)
+        for row in range(0, len(points), rows):
+            for col in range(0, len(points), cols):
+                if rows >= len(points) and cols >= len(points):
+                    self._fetch(points)
+                else:
+                    self._fetch(
+                        points,
+                        sources=list(range(row, min(row + rows, len(points)))),
+                        destinations=list(range(col, min(col + cols, len(points)))),
+                    )
+
+    def matrix(self, points):
+        """All pairwise driving times between points, as a NumPy array."""
+        keys = quantize(points).tolist()
+        if any((a, b) not in self.known for a in keys for b in keys):
+            self.prefetch([points])
+        return np.array([[self.known[(a, b)] for b in keys] for a in keys])
+
+
+MATRIX_PROVIDERS = {
+    LocalMatrixProvider.name: LocalMatrixProvider,
+    ORSMatrixProvider.name: ORSMatrixProvider,
+}
+
+
+def get_matrix_provider(name=None, cached=True):
+    """
+    Returns the provider named in settings.TRAVEL_TIME_PROVIDER
+    (or the one asked for). ORS is wrapped in the database cache
+    unless cached=False.
+    """
+    name = name or settings.TRAVEL_TIME_PROVIDER
+    try:
+        provider = MATRIX_PROVIDERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown travel time provider: {name}")
+    if cached and name == ORSMatrixProvider.name:
+        return CachedMatrixProvider(provider)
+    return provider
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-17 02:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TravelTimeCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin', models.BigIntegerField()),
+                ('destination', models.BigIntegerField()),
+                ('duration', models.FloatField(help_text='Driving time in seconds')),
+                ('distance', models.FloatField(blank=True, help_text='Road distance in meters', null=True)),
+                ('fetched_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('origin', 'destination'), name='unique_travel_time_pair')],
+            },
+        ),
+    ]
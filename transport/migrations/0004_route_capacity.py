@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-17 02:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0003_optimizationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='capacity',
+            field=models.PositiveIntegerField(default=5, help_text='Seats on the vehicle serving this route'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-17 02:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0004_route_capacity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('point_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='location_chunks', to='transport.route')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['route', 'day', 'start_time'], name='location_chunk_route_day')],
+            },
+        ),
+    ]
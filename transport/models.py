@@ -1,4 +1,7 @@
 # transport/models.py
+import uuid
+
+from django.conf import settings
 from django.db import models
 
 class Route(models.Model):
@@ -8,6 +11,96 @@ class Route(models.Model):
     """
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
+    capacity = models.PositiveIntegerField(
+        default=settings.BUS_CAPACITY,
+        help_text="Seats on the vehicle serving this route"
+    )
+
+    def __str__(self):
+        return self.name
+
+class TravelTimeCache(models.Model):
+    """
+    One cached driving time from an origin to a destination.
+    Points are stored as a single quantized integer key (see
+    transport/matrix.py) so nearby coordinates share an entry.
+    """
+    origin = models.BigIntegerField()
+    destination = models.BigIntegerField()
+    duration = models.FloatField(help_text="Driving time in seconds")
+    distance = models.FloatField(blank=True, null=True, help_text="Road distance in meters")
+
+    # When ORS gave us this value (for expiry) and when we last read it (for LRU)
+    fetched_at = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['origin', 'destination'], name='unique_travel_time_pair'),
+        ]
+
+    def __str__(self):
+        return f"{self.origin} -> {self.destination}: {self.duration:.0f}s"
+
+
+class OptimizationJob(models.Model):
+    """
+    One background run of the optimize_routes command.
+    Created by the admin "optimize" buttons; see transport/jobs.py.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    options = models.JSONField(default=dict, blank=True, help_text="Options passed to optimize_routes")
+    log = models.TextField(blank=True, help_text="Output of the command")
+    error = models.TextField(blank=True)
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='+'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Optimization {self.id} ({self.status})"
+
+
+class LocationChunk(models.Model):
+    """
+    A batch of GPS points from one route's bus on one day.
+    Points are packed into `data` as a NumPy structured array
+    (see transport/history.py); a new chunk is written every
+    time the ping buffer is flushed.
+    """
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='location_chunks')
+    day = models.DateField()
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    point_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['route', 'day', 'start_time'], name='location_chunk_route_day'),
+        ]
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return f"{self.route} {self.day}: {self.point_count} point(s)"
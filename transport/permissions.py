@@ -1,6 +1,8 @@
 # transport/permissions.py
 from rest_framework.permissions import BasePermission, IsAdminUser
 
+from .route_cache import get_driver_assignment
+
 class IsDriver(BasePermission):
     """
     Allows access only to users with the 'is_driver' flag.
@@ -8,7 +10,8 @@ class IsDriver(BasePermission):
     def has_permission(self, request, view):
         # Check if the user is logged in AND
         # has a related 'driverprofile' object.
+        # The driver lookup is cached, so pings don't hit the database here
         return (
             request.user.is_authenticated and
-            hasattr(request.user, 'driverprofile')
+            get_driver_assignment(request.user.id) is not None
         )
\ No newline at end of file
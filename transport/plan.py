@@ -0,0 +1,164 @@
+# transport/plan.py
+"""
+In-memory route plans.
+
+optimize_routes works out a RoutePlan first and only then decides
+whether to write it:
+
+    plan = RoutePlan()
+    plan.add_route('Route B', [12, 7, 31], times, order, college, route_id=4)
+    plan.diff(current)   # what would change, as text lines
+    plan.metrics()       # totals for comparing plans
+    plan.apply(current)  # write everything in one bulk phase
+
+Stops are StudentProfile ids. `current` maps each student id in the
+plan to where they are now:
+(route name or None, pickup_order, driving_time_seconds).
+Students without a location ride at the end of their route and have
+no driving time.
+"""
+from django.conf import settings
+from students.models import StudentProfile
+
+from .models import Route
+from .route_cache import invalidate_route
+
+BULK_BATCH_SIZE = 500
+UNASSIGNED = (None, None, None)
+
+
+class PlannedRoute:
+    """One bus in a plan: stops in pickup order and their timings."""
+
+    def __init__(self, name, stop_ids, leg_seconds, college_seconds, route_id=None, capacity=None):
+        self.name = name
+        self.route_id = route_id          # None for a route that does not exist yet
+        self.capacity = capacity          # Seats, for new routes
+        self.stop_ids = list(stop_ids)
+        self.leg_seconds = list(leg_seconds)          # stop -> next stop (last -> college)
+        self.college_seconds = list(college_seconds)  # college -> stop, saved as driving_time_seconds (None if unlocated)
+
+    @property
+    def is_new(self):
+        return self.route_id is None
+
+    @property
+    def duration(self):
+        return sum(self.leg_seconds)
+
+
+class RoutePlan:
+    """Every route an optimization run wants to create or change."""
+
+    def __init__(self):
+        self.routes = []
+
+    def add_route(self, name, stop_ids, times, order, end, route_id=None, capacity=None, unlocated_ids=()):
+        """
+        Adds a route from a duration matrix and a pickup order
+        (indices into stop_ids/times; `end` is the college's index).
+        New routes (no route_id) should say how many seats they have.
+        unlocated_ids (students with no location) are put last, in
+        the order given.
+        """
+        path = list(order) + [end]
+        unlocated_ids = list(unlocated_ids)
+        self.routes.append(PlannedRoute(
+            name,
+            [stop_ids[i] for i in order] + unlocated_ids,
+            [float(times[a, b]) for a, b in zip(path, path[1:])],
+            [float(times[end, i]) for i in order] + [None] * len(unlocated_ids),
+            route_id=route_id,
+            capacity=capacity,
+        ))
+        return self.routes[-1]
+
+    def placements(self):
+        """student id -> (route name, pickup_order) for every planned stop."""
+        return {
+            stop_id: (route.name, index + 1)
+            for route in self.routes
+            for index, stop_id in enumerate(route.stop_ids)
+        }
+
+    def metrics(self, current=None):
+        """Summary numbers for the plan (and how much it moves, given `current`)."""
+        durations = [route.duration for route in self.routes]
+        placements = self.placements()
+        metrics = {
+            'routes': len(self.routes),
+            'new_routes': sum(route.is_new for route in self.routes),
+            'new_seats': sum(route.capacity or 0 for route in self.routes if route.is_new),
+            'stops': len(placements),
+            'total_seconds': sum(durations),
+            'longest_seconds': max(durations, default=0),
+        }
+        if current is not None:
+            was = {stop_id: current.get(stop_id, UNASSIGNED)[:2] for stop_id in placements}
+            metrics['newly_assigned'] = sum(1 for stop_id in placements if was[stop_id][0] is None)
+            metrics['reordered'] = sum(
+                1 for stop_id, placement in placements.items()
+                if was[stop_id][0] is not None and was[stop_id] != placement
+            )
+        return metrics
+
+    def diff(self, current, labels=None):
+        """
+        Human-readable changes against `current`, one line per
+        route followed by one indented line per moved stop.
+        labels maps student id -> display name (defaults to the id).
+        """
+        labels = labels or {}
+        lines = []
+        for route in self.routes:
+            kind = f"new, {route.capacity} seats" if route.is_new else 'existing'
+            lines.append(f"{route.name} ({kind}): {len(route.stop_ids)} stop(s), ~{route.duration / 60:.0f} min")
+            for index, stop_id in enumerate(route.stop_ids):
+                was_route, was_order, _ = current.get(stop_id, UNASSIGNED)
+                label = labels.get(stop_id, stop_id)
+                if was_route is None:
+                    lines.append(f"  + {label} at stop {index + 1}")
+                elif was_route != route.name:
+                    lines.append(f"  > {label} from {was_route} stop {was_order} to stop {index + 1}")
+                elif was_order != index + 1:
+                    lines.append(f"  ~ {label} stop {was_order} -> {index + 1}")
+        return lines
+
+    def apply(self, current):
+        """
+        Writes the plan: creates the new routes, then saves route,
+        pickup_order and driving_time_seconds for every stop that
+        moved (or is missing a driving time it now has) in a single bulk_update,
+        and drops the changed routes' cached stops. Returns the
+        number of students written.
+        """
+        new_routes = [route for route in self.routes if route.is_new]
+        if new_routes:
+            Route.objects.bulk_create([
+                Route(name=route.name, capacity=route.capacity or settings.BUS_CAPACITY)
+                for route in new_routes
+            ])
+            ids = dict(Route.objects.filter(
+                name__in=[route.name for route in new_routes]
+            ).values_list('name', 'id'))
+            for route in new_routes:
+                route.route_id = ids[route.name]
+
+        changed = []
+        for route in self.routes:
+            for index, stop_id in enumerate(route.stop_ids):
+                was_route, was_order, was_seconds = current.get(stop_id, UNASSIGNED)
+                seconds = route.college_seconds[index]
+                if (was_route, was_order) == (route.name, index + 1) and (was_seconds is not None or seconds is None):
+                    continue
+                changed.append(StudentProfile(
+                    id=stop_id,
+                    route_id=route.route_id,
+                    pickup_order=index + 1,
+                    driving_time_seconds=None if seconds is None else round(seconds),
+                ))
+        StudentProfile.objects.bulk_update(
+            changed, ['route', 'pickup_order', 'driving_time_seconds'], batch_size=BULK_BATCH_SIZE
+        )
+        invalidate_route(*(route.route_id for route in self.routes))
+        return len(changed)
@@ -0,0 +1,163 @@
+# transport/route_cache.py
+"""
+Cached route data for the location-ping hot path.
+
+A driver's ping needs three things: which route the driver drives,
+that route's stops (positions and boarding flags) and who has been
+notified so far on this trip. All three live in Django's cache
+(Redis when REDIS_URL is set), so a steady-state ping does not touch
+the database. The stop list sent to riders when they connect
+(get_route_stops) is cached the same way:
+
+    assignment = get_driver_assignment(user_id)  # or None
+    fence = get_route_fence(assignment['route_id'])
+    with notification_state(assignment['route_id']) as notified:
+        fence.evaluate(longitude, latitude, notified)
+
+Notification state is per route and trip (one trip per route per
+day), changed under a short cache lock and expires after the day ends.
+
+Saving or deleting a StudentProfile, DriverProfile or Route drops the
+affected entries through the signal handlers in transport/signals.py.
+Bulk updates send no signals, so code that bulk-updates students must
+call invalidate_route(route_id) itself (as RoutePlan.apply() does).
+"""
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, time as clock, timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from drivers.models import DriverProfile
+from students.models import StudentProfile
+
+from .geofence import RouteGeofence
+from .serializers import RouteStopSerializer
+
+ROUTE_FENCE_TIMEOUT = 60 * 60       # seconds; also bounds staleness from edits we miss (stops too)
+DRIVER_ASSIGNMENT_TIMEOUT = 60 * 60  # seconds
+STATE_LOCK_TIMEOUT = 5               # seconds a crashed holder can block a route
+STATE_LOCK_WAIT = 2                  # seconds to wait for the lock before giving up
+TRIP_GRACE = timedelta(hours=1)      # keep state a little past midnight
+
+# Cached in place of None, so "not a driver" is remembered too
+_NOT_A_DRIVER = {'driver_id': None}
+
+
+def _fence_key(route_id):
+    return f"route_fence:{route_id}"
+
+
+def _stops_key(route_id):
+    return f"route_stops:{route_id}"
+
+
+def _driver_key(user_id):
+    return f"driver_assignment:{user_id}"
+
+
+def get_driver_assignment(user_id):
+    """
+    {'driver_id', 'route_id', 'route_name'} for a driver's user id
+    (route_id/route_name are None when unassigned), or None if the
+    user is not a driver.
+    """
+    assignment = cache.get(_driver_key(user_id))
+    if assignment is None:
+        row = DriverProfile.objects.filter(user_id=user_id).values(
+            'id', 'route_assigned_id', 'route_assigned__name'
+        ).first()
+        assignment = _NOT_A_DRIVER if row is None else {
+            'driver_id': row['id'],
+            'route_id': row['route_assigned_id'],
+            'route_name': row['route_assigned__name'],
+        }
+        cache.set(_driver_key(user_id), assignment, DRIVER_ASSIGNMENT_TIMEOUT)
+    return None if assignment['driver_id'] is None else assignment
+
+
+def invalidate_driver(user_id):
+    cache.delete(_driver_key(user_id))
+
+
+def get_route_fence(route_id):
+    """The route's RouteGeofence, built from the database on a miss."""
+    fence = cache.get(_fence_key(route_id))
+    if fence is None:
+        fence = RouteGeofence.from_students(StudentProfile.objects.filter(route_id=route_id))
+        cache.set(_fence_key(route_id), fence, ROUTE_FENCE_TIMEOUT)
+    return fence
+
+
+def get_route_stops(route_id):
+    """The route's stops in pickup order, as RouteStopSerializer data."""
+    stops = cache.get(_stops_key(route_id))
+    if stops is None:
+        students = StudentProfile.objects.filter(route_id=route_id).select_related('user').order_by('pickup_order')
+        stops = [dict(stop) for stop in RouteStopSerializer(students, many=True).data]
+        cache.set(_stops_key(route_id), stops, ROUTE_FENCE_TIMEOUT)
+    return stops
+
+
+def invalidate_route(*route_ids):
+    """
+    Drops the cached stops of every given route (None is ignored)
+    once the current transaction commits, so a ping can't re-cache
+    the old rows in between.
+    """
+    keys = [
+        key for route_id in route_ids if route_id is not None
+        for key in (_fence_key(route_id), _stops_key(route_id))
+    ]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def current_trip():
+    """Id of the trip running now: one per route per (local) day."""
+    return timezone.localdate().isoformat()
+
+
+def _trip_timeout():
+    """Seconds until today's trip state can be thrown away."""
+    tomorrow = datetime.combine(timezone.localdate() + timedelta(days=1), clock.min)
+    end = timezone.make_aware(tomorrow) + TRIP_GRACE
+    return max(int((end - timezone.now()).total_seconds()), 1)
+
+
+def _state_key(route_id, trip):
+    return f"geofence_state:{route_id}:{trip}"
+
+
+@contextmanager
+def notification_state(route_id, trip=None):
+    """
+    Locks the route's notification state for this trip and yields it
+    as {student_id: last threshold}. Changes made to the dict are
+    saved when the block exits. Raises TimeoutError if another
+    request holds the lock for longer than STATE_LOCK_WAIT.
+    """
+    trip = trip or current_trip()
+    key = _state_key(route_id, trip)
+    lock_key = f"{key}:lock"
+    token = uuid.uuid4().hex
+
+    deadline = time.monotonic() + STATE_LOCK_WAIT
+    while not cache.add(lock_key, token, STATE_LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Geofence state for route {route_id} is busy.")
+        time.sleep(0.02)
+
+    try:
+        state = cache.get(key) or {}
+        before = dict(state)
+        yield state
+        if state != before:
+            cache.set(key, state, _trip_timeout())
+    finally:
+        # Only release our own lock (it may have expired and been taken)
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
@@ -3,4 +3,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'^ws/track/$', consumers.BusConsumer.as_asgi()),
+    re_path(r'^ws/optimization/(?P<job_id>[0-9a-f-]+)/$', consumers.OptimizationJobConsumer.as_asgi()),
+    re_path(r'^ws/replay/(?P<route_id>\d+)/$', consumers.TraceReplayConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,59 @@
+# transport/signals.py
+"""
+Keeps the cached driver -> route mapping and route stops
+(transport/route_cache.py), token users (transport/authentication.py)
+and socket identities (transport/consumers.py) in step with edits of users, drivers,
+students and routes, wherever they are made (views or the admin).
+Bulk updates don't send signals; RoutePlan.apply() invalidates its
+routes itself.
+"""
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from drivers.models import DriverProfile
+from students.models import StudentProfile
+
+from .authentication import user_cache_key
+from .consumers import socket_identity_key
+from .models import Route
+from .route_cache import invalidate_driver, invalidate_route
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, **kwargs):
+    cache.delete_many([user_cache_key(instance.pk), socket_identity_key(instance.pk)])
+
+
+@receiver([post_save, post_delete], sender=DriverProfile)
+def driver_changed(sender, instance, **kwargs):
+    invalidate_driver(instance.user_id)
+    cache.delete(socket_identity_key(instance.user_id))
+
+
+@receiver(pre_save, sender=StudentProfile)
+def remember_student_route(sender, instance, **kwargs):
+    # A student moved to another route changes the stops of both
+    instance._previous_route_id = StudentProfile.objects.filter(
+        pk=instance.pk
+    ).values_list('route_id', flat=True).first() if instance.pk else None
+
+
+@receiver([post_save, post_delete], sender=StudentProfile)
+def student_changed(sender, instance, **kwargs):
+    invalidate_route(instance.route_id, getattr(instance, '_previous_route_id', None))
+    cache.delete(socket_identity_key(instance.user_id))
+
+
+@receiver([post_save, pre_delete], sender=Route)
+def route_changed(sender, instance, **kwargs):
+    # The cached mapping holds the route's name, so renames matter too.
+    # Deletes are handled before the drivers are detached from the route.
+    driver_ids = list(DriverProfile.objects.filter(route_assigned_id=instance.id).values_list('user_id', flat=True))
+    for user_id in driver_ids:
+        invalidate_driver(user_id)
+    invalidate_route(instance.id)
+    # Socket identities hold the route's name too
+    student_ids = StudentProfile.objects.filter(route_id=instance.id).values_list('user_id', flat=True)
+    cache.delete_many([socket_identity_key(user_id) for user_id in [*driver_ids, *student_ids]])
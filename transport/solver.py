@@ -0,0 +1,536 @@
+# transport/solver.py
+"""
+Local route-planning helpers used by the optimize_routes command.
+
+Everything in here works on plain [lon, lat] lists (the same shape
+ORS uses), so it can run without touching the database or calling
+the ORS API. Driving times come from the offline model in
+transport/matrix.py; ORS is only used afterwards to fine-tune
+pickup orders.
+"""
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import django
+import numpy as np
+from django.conf import settings
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import KMeans
+
+from .matrix import estimate_durations
+
+# --- CONFIGURATION ---
+# Largest number of buses clustered in one go (bigger waitlists are split first)
+CLUSTER_BLOCK_ROUTES = 20
+# How many times each block re-centers and re-assigns its seats
+CLUSTER_REFINE_ROUNDS = 5
+# Longest run of stops Or-opt tries to move in one go
+OR_OPT_MAX_SEGMENT = 3
+# How far (radians) a randomized start may tilt each bisection cut
+SEARCH_SPLIT_NOISE = 0.5
+# Most vehicle mixes choose_fleet() plans before settling
+FLEET_SEARCH_ROUNDS = 6
+
+
+def insertion_costs(college_loc, ordered_locs, student_locs):
+    """
+    Works out, for every student at once, where they would add the
+    least driving time to a route.
+    Returns two arrays: (extra_seconds, position) per student, where
+    position is the index the new stop should be inserted at.
+    """
+    path = np.asarray(list(ordered_locs) + [college_loc], dtype=float)
+    to_path = estimate_durations(student_locs, path)       # student -> stop
+    from_path = estimate_durations(path, student_locs).T   # stop -> student
+    legs = np.diag(estimate_durations(path[:-1], path[1:])) # existing legs
+
+    # Column 0: the new student becomes the first pickup, which only adds one leg.
+    # Column p: the new student goes between path[p-1] and path[p].
+    costs = np.empty_like(to_path)
+    costs[:, 0] = to_path[:, 0]
+    costs[:, 1:] = from_path[:, :-1] + to_path[:, 1:] - legs
+
+    positions = costs.argmin(axis=1)
+    return costs[np.arange(len(costs)), positions], positions
+
+
+def sequence_duration(times, order, end):
+    """
+    Seconds to drive through the stops in `order` and then to `end`.
+    `times` is a full driving-time matrix; order/end are indices into it.
+    """
+    path = list(order) + [end]
+    return float(sum(times[a, b] for a, b in zip(path, path[1:])))
+
+
+def best_insertion(times, order, new, end):
+    """
+    Where in `order` (indices into the driving-time matrix `times`)
+    the stop `new` adds the least time, with `end` as the last stop.
+    Returns (extra_seconds, position).
+    """
+    path = list(order) + [end]
+    best_cost, best_position = float(times[new, path[0]]), 0
+    for position in range(1, len(path)):
+        before, after = path[position - 1], path[position]
+        cost = float(times[before, new] + times[new, after] - times[before, after])
+        if cost < best_cost:
+            best_cost, best_position = cost, position
+    return best_cost, best_position
+
+
+def _two_opt_pass(times, order, end, deadline):
+    """
+    One pass of 2-opt: reverse order[i..j] whenever that makes the
+    trip shorter. Works for one-way (asymmetric) times too, by keeping
+    running totals of each leg driven forwards and backwards.
+    Returns True if anything changed.
+    """
+    n = len(order)
+    improved = False
+    i = 0
+    while i < n - 1:
+        forward = [0.0]
+        backward = [0.0]
+        for a, b in zip(order, order[1:]):
+            forward.append(forward[-1] + times[a, b])
+            backward.append(backward[-1] + times[b, a])
+
+        for j in range(i + 1, n):
+            before = order[i - 1] if i > 0 else None
+            after = order[j + 1] if j + 1 < n else end
+
+            old = (forward[j] - forward[i]) + times[order[j], after]
+            new = (backward[j] - backward[i]) + times[order[i], after]
+            if before is not None:
+                old += times[before, order[i]]
+                new += times[before, order[j]]
+
+            if new < old - 1e-9:
+                order[i:j + 1] = order[i:j + 1][::-1]
+                improved = True
+                break  # Running totals are stale, redo this i
+        else:
+            i += 1
+        if time.perf_counter() > deadline:
+            break
+    return improved
+
+
+def _or_opt_pass(times, order, end, deadline):
+    """
+    One pass of Or-opt: take a run of 1 to OR_OPT_MAX_SEGMENT stops
+    and move it elsewhere in the trip (same direction) if that is
+    shorter. Returns True if anything changed.
+    """
+    def leg(a, b):
+        return 0.0 if a is None else times[a, b]
+
+    improved = False
+    for length in range(1, OR_OPT_MAX_SEGMENT + 1):
+        i = 0
+        while i + length <= len(order):
+            segment = order[i:i + length]
+            before = order[i - 1] if i > 0 else None
+            after = order[i + length] if i + length < len(order) else end
+            saved = leg(before, segment[0]) + times[segment[-1], after] - leg(before, after)
+
+            rest = order[:i] + order[i + length:]
+            best_gain, best_position = 1e-9, None
+            for position in range(len(rest) + 1):
+                if position == i:
+                    continue  # That's where it came from
+                a = rest[position - 1] if position > 0 else None
+                b = rest[position] if position < len(rest) else end
+                added = leg(a, segment[0]) + times[segment[-1], b] - leg(a, b)
+                if saved - added > best_gain:
+                    best_gain, best_position = saved - added, position
+
+            if best_position is not None:
+                order[:] = rest[:best_position] + segment + rest[best_position:]
+                improved = True
+            else:
+                i += 1
+            if time.perf_counter() > deadline:
+                return improved
+    return improved
+
+
+def improve_order(times, order, end, time_budget=None):
+    """
+    Polishes a pickup order with 2-opt and Or-opt moves until neither
+    finds anything better or the time budget (seconds) runs out.
+    `times` is the full stop-to-stop matrix; `end` (the college) stays last.
+    Returns a new list.
+    """
+    if time_budget is None:
+        time_budget = settings.ROUTE_SEARCH_SECONDS
+    deadline = time.perf_counter() + time_budget
+    order = list(order)
+    if len(order) < 2:
+        return order
+
+    while time.perf_counter() < deadline:
+        changed = _two_opt_pass(times, order, end, deadline)
+        changed = _or_opt_pass(times, order, end, deadline) or changed
+        if not changed:
+            break
+    return order
+
+
+def farthest_first_order(times, stops, end):
+    """`stops` sorted so the bus starts at the one farthest from `end`."""
+    return sorted(stops, key=lambda i: times[end, i], reverse=True)
+
+
+def plan_pickup_order(times, stops, end, time_budget=None):
+    """
+    Pickup order for `stops` (indices into times): start from the
+    farthest-from-college order and improve it with local search.
+    """
+    return improve_order(times, farthest_first_order(times, stops, end), end, time_budget)
+
+
+def assign_to_routes(college_loc, route_stops, free_slots, student_locs):
+    """
+    Greedily fills the free seats on existing routes.
+
+    route_stops:  list of [lon, lat] lists, one per route, in pickup order
+    free_slots:   number of free seats on each route
+    student_locs: [lon, lat] of every waitlisted student
+
+    The student that adds the least driving time to the fleet is placed
+    first, then the next cheapest, and so on until the seats run out.
+    Returns a list of (student_index, route_index) pairs.
+    """
+    if not student_locs or not route_stops:
+        return []
+
+    route_stops = [list(stops) for stops in route_stops]
+    free_slots = list(free_slots)
+    student_locs = np.asarray(student_locs, dtype=float)
+
+    # One column per route: the cost of adding each student to it
+    costs = np.full((len(student_locs), len(route_stops)), np.inf)
+    positions = np.zeros(costs.shape, dtype=int)
+    placed = np.zeros(len(student_locs), dtype=bool)
+
+    def refresh(route_index):
+        if free_slots[route_index] <= 0:
+            costs[:, route_index] = np.inf
+            return
+        column, where = insertion_costs(college_loc, route_stops[route_index], student_locs)
+        column[placed] = np.inf
+        costs[:, route_index] = column
+        positions[:, route_index] = where
+
+    for route_index in range(len(route_stops)):
+        refresh(route_index)
+
+    assignments = []
+    while True:
+        student_index, route_index = np.unravel_index(costs.argmin(), costs.shape)
+        if not np.isfinite(costs[student_index, route_index]):
+            break
+
+        position = positions[student_index, route_index]
+        route_stops[route_index].insert(position, student_locs[student_index].tolist())
+        free_slots[route_index] -= 1
+        placed[student_index] = True
+        costs[student_index, :] = np.inf
+        assignments.append((int(student_index), int(route_index)))
+
+        # Only the route that changed needs its costs worked out again
+        refresh(route_index)
+
+    return assignments
+
+
+def fleet_mix(student_count, fleet):
+    """
+    Picks the vehicles for new routes: seats as many of
+    `student_count` students as possible with every vehicle full,
+    using as few vehicles as possible.
+
+    fleet: {seats: vehicles available (None for no limit)}, e.g. {40: 3, 5: None}
+    Returns a list of capacities, largest first (empty if not even
+    the smallest vehicle can be filled).
+    """
+    # A bounded knapsack: each size's vehicles are bundled in powers
+    # of two (1, 2, 4, ...) and every bundle is used at most once
+    bundles = []
+    for seats, available in sorted(fleet.items(), reverse=True):
+        if seats <= 0:
+            continue
+        limit = student_count // seats
+        if available is not None:
+            limit = min(limit, available)
+        size = 1
+        while limit > 0:
+            count = min(size, limit)
+            bundles.append((seats, count))
+            limit -= count
+            size *= 2
+
+    # fewest[s] = fewest vehicles that seat exactly s students (inf if impossible)
+    fewest = np.full(student_count + 1, np.inf)
+    fewest[0] = 0
+    used = np.zeros((len(bundles), student_count + 1), dtype=bool)
+    for i, (seats, count) in enumerate(bundles):
+        width = seats * count
+        with_bundle = np.full_like(fewest, np.inf)
+        with_bundle[width:] = fewest[:len(fewest) - width] + count
+        used[i] = with_bundle < fewest
+        fewest = np.minimum(fewest, with_bundle)
+
+    seated = int(np.flatnonzero(np.isfinite(fewest))[-1])
+    capacities = []
+    for i in reversed(range(len(bundles))):
+        if used[i, seated]:
+            seats, count = bundles[i]
+            capacities += [seats] * count
+            seated -= seats * count
+    return sorted(capacities, reverse=True)
+
+
+def _fleet_score(result, max_route_seconds):
+    """
+    Sort key for choose_fleet(): plans whose every route fits come
+    first, then the one seating the most students, then the cheapest
+    (or, if none fits, the one whose longest route is shortest).
+    """
+    fits = result['longest'] <= max_route_seconds
+    return (not fits, -sum(result['capacities']), result['cost'] if fits else result['longest'])
+
+
+def choose_fleet(college_loc, student_locs, fleet, max_route_seconds, vehicle_seconds, seed=0):
+    """
+    Picks the vehicle mix for the waitlist by planning it.
+
+    Starts from the fewest vehicles that seat the most students
+    (fleet_mix) and plans their routes on the offline model. While
+    a route is longer than max_route_seconds, the largest vehicles
+    on too-long routes are swapped for smaller ones and the plan is
+    redone. Once every route fits, one more swap is tried in case
+    the shorter driving pays for the extra vehicle.
+
+    Each plan costs vehicle_seconds per vehicle plus its total
+    driving time. Returns the best search_start() result, with its
+    'capacities' and 'cost' added.
+    """
+    available = dict(fleet)
+    smallest = min(available)
+    best = None
+    for _ in range(FLEET_SEARCH_ROUNDS):
+        capacities = fleet_mix(len(student_locs), available)
+        if not capacities:
+            break
+        result = search_start(college_loc, student_locs, capacities, seed)
+        result['capacities'] = capacities
+        result['cost'] = vehicle_seconds * len(capacities) + result['duration']
+        improved = best is None or _fleet_score(result, max_route_seconds) < _fleet_score(best, max_route_seconds)
+        if improved:
+            best = result
+
+        too_long = [
+            seats for seats, seconds in zip(capacities, result['durations'])
+            if seconds > max_route_seconds and seats > smallest
+        ]
+        if too_long:
+            shrink, fewer = max(too_long), too_long.count(max(too_long))
+        elif improved and capacities[0] > smallest:
+            shrink, fewer = capacities[0], 1
+        else:
+            break
+        available[shrink] = capacities.count(shrink) - fewer
+    return best
+
+
+def _planar(student_locs):
+    """
+    Projects [lon, lat] onto a flat x/y grid (in degrees of latitude)
+    so that plain Euclidean clustering is fair in every direction.
+    """
+    locs = np.asarray(student_locs, dtype=float).reshape(-1, 2)
+    if not len(locs):
+        return locs
+    scale = math.cos(math.radians(locs[:, 1].mean()))
+    return np.column_stack([locs[:, 0] * scale, locs[:, 1]])
+
+
+def _assign_to_slots(points, centers, capacities):
+    """
+    Optimal assignment of points to centers where center j takes at
+    most capacities[j] points (minimum total squared distance).
+    Points that do not fit anywhere get -1.
+    """
+    slot_owner = np.repeat(np.arange(len(centers)), capacities)
+    cost = ((points[:, None, :] - centers[slot_owner][None, :, :]) ** 2).sum(axis=2)
+    rows, cols = linear_sum_assignment(cost)
+    labels = np.full(len(points), -1)
+    labels[rows] = slot_owner[cols]
+    return labels
+
+
+def _cluster_block(points, capacities, random_state):
+    """
+    Capacitated k-means for one small block: KMeans picks the
+    starting centers, then each round assigns points to seats
+    exactly and moves the centers to their new members.
+    """
+    kmeans = KMeans(n_clusters=len(capacities), n_init=3, random_state=random_state)
+    centers = kmeans.fit(points).cluster_centers_
+
+    labels = _assign_to_slots(points, centers, capacities)
+    for _ in range(CLUSTER_REFINE_ROUNDS):
+        centers = np.array([
+            points[labels == j].mean(axis=0) if (labels == j).any() else centers[j]
+            for j in range(len(capacities))
+        ])
+        new_labels = _assign_to_slots(points, centers, capacities)
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+    return labels
+
+
+def capacitated_clusters(student_locs, capacities, random_state=0, split_noise=0.0):
+    """
+    Splits students into len(capacities) geographically compact
+    groups, where group i holds exactly capacities[i] students.
+    Students that do not fit (the leftovers) are not returned.
+
+    Big waitlists are first cut in half along their longest side,
+    again and again, until each piece holds at most
+    CLUSTER_BLOCK_ROUTES buses; each piece is then clustered with
+    KMeans and an exact seat assignment. This keeps the work
+    roughly linear in the number of students.
+
+    split_noise tilts every cut by a random angle (up to that many
+    radians, drawn from random_state) so different seeds give
+    different but equally compact plans.
+
+    Returns a list of index lists, one per entry in capacities.
+    """
+    points = _planar(student_locs)
+    clusters = [[] for _ in capacities]
+    rng = np.random.default_rng(random_state)
+
+    def split(indices, route_ids):
+        seats = sum(capacities[r] for r in route_ids)
+        if len(route_ids) <= CLUSTER_BLOCK_ROUTES:
+            if len(route_ids) == 1 and len(indices) == seats:
+                clusters[route_ids[0]] = indices.tolist()
+                return
+            labels = _cluster_block(
+                points[indices], [capacities[r] for r in route_ids], random_state
+            )
+            for label, index in zip(labels, indices):
+                if label >= 0:
+                    clusters[route_ids[label]].append(int(index))
+            return
+
+        # Cut along whichever direction the students are most spread out
+        block = points[indices]
+        angle = math.pi / 2 if np.ptp(block[:, 1]) > np.ptp(block[:, 0]) else 0.0
+        if split_noise:
+            angle += rng.uniform(-split_noise, split_noise)
+        along = block @ np.array([math.cos(angle), math.sin(angle)])
+        indices = indices[np.argsort(along, kind='stable')]
+
+        half = len(route_ids) // 2
+        left, right = route_ids[:half], route_ids[half:]
+        left_seats = sum(capacities[r] for r in left)
+        right_seats = seats - left_seats
+        # Spread the leftovers in proportion to the seats on each side
+        cut = round(len(indices) * left_seats / seats)
+        cut = min(max(cut, left_seats), len(indices) - right_seats)
+        split(indices[:cut], left)
+        split(indices[cut:], right)
+
+    if capacities and len(points) >= sum(capacities):
+        split(np.arange(len(points)), list(range(len(capacities))))
+    return clusters
+
+
+def seeded_clusters(student_locs, capacities, seed):
+    """
+    capacitated_clusters for one search start. Seed 0 is the plain,
+    untilted clustering; any other seed also tilts the cuts.
+    """
+    noise = SEARCH_SPLIT_NOISE if seed else 0.0
+    return capacitated_clusters(student_locs, capacities, random_state=seed, split_noise=noise)
+
+
+def search_start(college_loc, student_locs, capacities, seed, deadline=None):
+    """
+    One randomized start of the new-route search: cluster the
+    students with this seed, then plan every bus's pickup order on
+    the offline model.
+
+    Returns {'seed', 'duration', 'durations', 'longest', 'clusters'}
+    (total, per-route and longest route seconds), or None if the
+    deadline (a time.time() value) passed before it finished.
+    """
+    clusters = seeded_clusters(student_locs, capacities, seed)
+    student_locs = np.asarray(student_locs, dtype=float).reshape(-1, 2)
+    durations = []
+    for cluster in clusters:
+        if deadline is not None and time.time() > deadline:
+            return None
+        path = np.vstack([student_locs[cluster], [college_loc]])
+        times = estimate_durations(path, path)
+        college = len(cluster)
+        order = plan_pickup_order(times, range(college), college)
+        durations.append(sequence_duration(times, order, college))
+    return {
+        'seed': seed,
+        'duration': sum(durations),
+        'durations': durations,
+        'longest': max(durations, default=0.0),
+        'clusters': clusters,
+    }
+
+
+def multi_start_clusters(college_loc, student_locs, capacities, seeds, workers=None, time_budget=None):
+    """
+    Runs search_start once per seed across a pool of worker
+    processes and keeps the plan with the shortest total driving
+    time (ties go to the lower seed, so a given seed set always
+    gives the same answer as long as every start finishes).
+
+    time_budget is the wall-clock limit in seconds for the whole
+    search; starts still running when it runs out are dropped.
+    If none finished, the first seed is run here without a limit.
+
+    Returns (best_result, finished_count).
+    """
+    seeds = list(seeds)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(seeds)))
+    deadline = time.time() + time_budget if time_budget else None
+
+    # Spawned (not forked) workers: the command may run inside a threaded
+    # web process. Each one sets Django up again before taking work.
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=django.setup,
+    )
+    try:
+        futures = [
+            pool.submit(search_start, college_loc, student_locs, capacities, seed, deadline)
+            for seed in seeds
+        ]
+        done, _ = wait(futures, timeout=time_budget)
+        results = [f.result() for f in done if f.exception() is None and f.result() is not None]
+    finally:
+        # Unstarted seeds are cancelled; running ones stop at the deadline
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if not results:
+        return search_start(college_loc, student_locs, capacities, seeds[0]), 0
+    best = min(results, key=lambda r: (r['duration'], r['seed']))
+    return best, len(results)
@@ -1,3 +1,806 @@
-from django.test import TestCase
+import itertools
+import asyncio
+import io
+import math
+import random
+from datetime import timedelta
 
-# Create your tests here.
+import msgpack
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from drivers.models import DriverProfile
+from students.models import StudentProfile
+
+from . import jobs, solver, wire
+from .management.commands.optimize_routes import Command as OptimizeRoutesCommand
+from .history import flush_history
+from .locations import flush_locations, get_live_location
+from .matrix import CachedMatrixProvider, DurationTable, LocalMatrixProvider, prune_travel_time_cache, quantize
+from .models import LocationChunk, Route, TravelTimeCache
+from .plan import UNASSIGNED, RoutePlan
+from .route_cache import get_driver_assignment
+from .tracking import MAX_BATCH_POINTS, parse_points, publish_location, route_group_name, should_broadcast
+from .geofence import FINAL_THRESHOLD, NOTIFICATION_DISTANCES, RouteGeofence
+from .utils import haversine, route_letters
+
+# Meters per degree of latitude on the sphere haversine() uses
+METERS_PER_DEGREE = 6371000 * math.pi / 180
+
+STOP_LON, STOP_LAT = 77.59, 12.97
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def north_of_stop(meters):
+    """A (longitude, latitude) ping `meters` north of the test stop."""
+    return STOP_LON, STOP_LAT + meters / METERS_PER_DEGREE
+
+
+def old_geofence_loop(stops, longitude, latitude, notified):
+    """
+    The per-student loop RouteGeofence.evaluate() replaced, kept here
+    to check the vectorized version against. stops is a list of
+    (student_id, longitude, latitude, is_boarding_today).
+    """
+    sent = []
+    for student_id, stop_lon, stop_lat, boarding in stops:
+        if not boarding:
+            continue
+        distance_meters = int(haversine(longitude, latitude, stop_lon, stop_lat) * 1000)
+
+        current_threshold = None
+        for threshold in NOTIFICATION_DISTANCES:
+            if distance_meters <= threshold:
+                current_threshold = threshold
+
+        if current_threshold is None:
+            notified.pop(student_id, None)
+            continue
+
+        if current_threshold <= FINAL_THRESHOLD:
+            if notified.get(student_id) != FINAL_THRESHOLD:
+                sent.append((student_id, current_threshold, distance_meters, True))
+                notified[student_id] = FINAL_THRESHOLD
+            continue
+
+        if notified.get(student_id) is None or current_threshold < notified[student_id]:
+            sent.append((student_id, current_threshold, distance_meters, False))
+            notified[student_id] = current_threshold
+    return sent
+
+
+class RouteGeofenceTests(SimpleTestCase):
+    def setUp(self):
+        self.fence = RouteGeofence([1], [STOP_LON], [STOP_LAT], [True])
+        self.notified = {}
+
+    def ping(self, meters):
+        return self.fence.evaluate(*north_of_stop(meters), self.notified)
+
+    def test_each_threshold_is_sent_once_on_the_way_in(self):
+        sent = [n['threshold'] for meters in [900, 450, 420, 350, 250, 150, 120, 50] for n in self.ping(meters)]
+        self.assertEqual(sent, [500, 400, 300, 200, 100])
+        self.assertEqual(self.notified, {1: 100})
+
+    def test_skipped_thresholds_send_only_the_closest(self):
+        [notification] = self.ping(150.5)
+        self.assertEqual(notification['threshold'], 200)
+        self.assertEqual(notification['distance'], 150)
+        self.assertFalse(notification['final'])
+
+    def test_moving_away_inside_the_zone_sends_nothing(self):
+        self.ping(150)
+        self.assertEqual(self.ping(350), [])
+        self.assertEqual(self.notified, {1: 200})
+
+    def test_final_call_is_sent_once(self):
+        self.ping(150)
+        [final] = self.ping(20)
+        self.assertTrue(final['final'])
+        self.assertEqual(final['threshold'], FINAL_THRESHOLD)
+        self.assertEqual(self.ping(10), [])
+        self.assertEqual(self.ping(5), [])
+        # Not even after drifting out to 100m and back
+        self.assertEqual(self.ping(80), [])
+        self.assertEqual(self.ping(10), [])
+
+    def test_leaving_the_500m_zone_resets(self):
+        self.ping(450)
+        self.ping(20)
+        self.assertEqual(self.ping(700), [])
+        self.assertEqual(self.notified, {})
+        self.assertEqual([n['threshold'] for n in self.ping(450)], [500])
+
+    def test_students_not_boarding_are_ignored(self):
+        fence = RouteGeofence([1, 2], [STOP_LON, STOP_LON], [STOP_LAT, STOP_LAT], [True, False])
+        sent = fence.evaluate(*north_of_stop(20), self.notified)
+        self.assertEqual([n['student_id'] for n in sent], [1])
+        self.assertEqual(self.notified, {1: FINAL_THRESHOLD})
+
+    def test_a_student_who_stops_boarding_keeps_their_state(self):
+        self.notified[2] = 300
+        fence = RouteGeofence([2], [STOP_LON], [STOP_LAT], [False])
+        self.assertEqual(fence.evaluate(*north_of_stop(900), self.notified), [])
+        self.assertEqual(self.notified, {2: 300})
+
+    def test_empty_route(self):
+        self.assertEqual(RouteGeofence([], [], [], []).evaluate(STOP_LON, STOP_LAT, self.notified), [])
+
+    def test_matches_the_old_loop_on_random_trips(self):
+        rng = random.Random(0)
+        for trip in range(300):
+            stops = [
+                (
+                    student_id,
+                    STOP_LON + rng.uniform(-0.01, 0.01),
+                    STOP_LAT + rng.uniform(-0.01, 0.01),
+                    rng.random() < 0.8,
+                )
+                for student_id in range(1, rng.randint(1, 15))
+            ]
+            fence = RouteGeofence(*zip(*stops)) if stops else RouteGeofence([], [], [], [])
+            notified, expected_notified = {}, {}
+
+            # The bus drives past every stop in a random order, a few meters off
+            path = [(STOP_LON + rng.uniform(-0.02, 0.02), STOP_LAT + rng.uniform(-0.02, 0.02))]
+            for _, stop_lon, stop_lat, _ in rng.sample(stops, len(stops)):
+                target = (stop_lon + rng.uniform(-0.0003, 0.0003), stop_lat + rng.uniform(-0.0003, 0.0003))
+                start = path[-1]
+                path += [
+                    (start[0] + (target[0] - start[0]) * k / 8, start[1] + (target[1] - start[1]) * k / 8)
+                    for k in range(1, 9)
+                ]
+
+            for step, (lon, lat) in enumerate(path):
+                got = [
+                    (n['student_id'], n['threshold'], n['distance'], n['final'])
+                    for n in fence.evaluate(lon, lat, notified)
+                ]
+                expected = old_geofence_loop(stops, lon, lat, expected_notified)
+                self.assertEqual(sorted(got), sorted(expected), f"trip {trip}, step {step}")
+                self.assertEqual(notified, expected_notified, f"trip {trip}, step {step}")
+
+
+def random_locs(count, seed=0):
+    """count [lon, lat] points spread over a city-sized area."""
+    rng = np.random.default_rng(seed)
+    return np.column_stack([
+        STOP_LON + rng.uniform(-0.1, 0.1, count), STOP_LAT + rng.uniform(-0.1, 0.1, count)
+    ]).tolist()
+
+
+class FleetMixTests(SimpleTestCase):
+    def test_unlimited_fleet_prefers_big_vehicles(self):
+        self.assertEqual(solver.fleet_mix(100, {40: None, 5: None}), [40, 40, 5, 5, 5, 5])
+
+    def test_limited_fleet(self):
+        self.assertEqual(solver.fleet_mix(100, {40: 1, 5: 3}), [40, 5, 5, 5])
+
+    def test_too_few_students_to_fill_a_vehicle(self):
+        self.assertEqual(solver.fleet_mix(4, {5: None}), [])
+        self.assertEqual(solver.fleet_mix(0, {5: None}), [])
+
+    def test_matches_brute_force(self):
+        fleet = {7: 2, 3: None}
+        for count in range(41):
+            # Most students seated with every vehicle full, then fewest vehicles
+            seated, fewer = max(
+                (7 * big + 3 * small, -(big + small))
+                for big, small in itertools.product(range(3), range(count // 3 + 1))
+                if 7 * big + 3 * small <= count
+            )
+            mix = solver.fleet_mix(count, fleet)
+            self.assertEqual((sum(mix), len(mix)), (seated, -fewer), count)
+            self.assertLessEqual(mix.count(7), 2)
+
+
+class CapacitatedClustersTests(SimpleTestCase):
+    def assertExactGroups(self, clusters, capacities, student_count):
+        self.assertEqual([len(cluster) for cluster in clusters], capacities)
+        everyone = [i for cluster in clusters for i in cluster]
+        self.assertEqual(len(everyone), len(set(everyone)))
+        self.assertTrue(all(0 <= i < student_count for i in everyone))
+
+    def test_groups_have_exact_sizes(self):
+        capacities = [40, 5, 5, 5]
+        clusters = solver.capacitated_clusters(random_locs(57), capacities)
+        self.assertExactGroups(clusters, capacities, 57)
+
+    def test_large_waitlists_are_split_into_blocks(self):
+        capacities = [5] * (solver.CLUSTER_BLOCK_ROUTES * 2 + 3)
+        clusters = solver.capacitated_clusters(random_locs(230, seed=1), capacities, split_noise=0.5)
+        self.assertExactGroups(clusters, capacities, 230)
+
+    def test_not_enough_students(self):
+        self.assertEqual(solver.capacitated_clusters(random_locs(8), [5, 5]), [[], []])
+
+
+class AssignToRoutesTests(SimpleTestCase):
+    def test_free_seats_are_respected(self):
+        route_stops = [random_locs(3, seed=1), random_locs(4, seed=2), random_locs(2, seed=3)]
+        free_slots = [2, 0, 1]
+        assignments = solver.assign_to_routes(
+            [STOP_LON, STOP_LAT], route_stops, free_slots, random_locs(10, seed=4)
+        )
+        self.assertEqual(len(assignments), sum(free_slots))
+        students = [student for student, _ in assignments]
+        self.assertEqual(len(students), len(set(students)))
+        for route_index, seats in enumerate(free_slots):
+            self.assertEqual(sum(1 for _, route in assignments if route == route_index), seats)
+
+    def test_fewer_students_than_seats(self):
+        assignments = solver.assign_to_routes(
+            [STOP_LON, STOP_LAT], [random_locs(3)], [5], random_locs(2, seed=1)
+        )
+        self.assertEqual(sorted(student for student, _ in assignments), [0, 1])
+
+    def test_nothing_to_assign(self):
+        self.assertEqual(solver.assign_to_routes([STOP_LON, STOP_LAT], [], [], random_locs(3)), [])
+
+
+class ImproveOrderTests(SimpleTestCase):
+    def test_never_worse_than_the_start(self):
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            size = int(rng.integers(2, 15))
+            # Asymmetric times, like real one-way streets
+            times = rng.uniform(60, 1800, (size + 1, size + 1))
+            np.fill_diagonal(times, 0)
+            start = rng.permutation(size).tolist()
+            improved = solver.improve_order(times, start, size, time_budget=5)
+            self.assertEqual(sorted(improved), sorted(start))
+            self.assertLessEqual(
+                solver.sequence_duration(times, improved, size), solver.sequence_duration(times, start, size)
+            )
+
+    def test_short_orders_are_returned_as_is(self):
+        times = np.zeros((2, 2))
+        self.assertEqual(solver.improve_order(times, [0], 1, time_budget=1), [0])
+
+
+class RouteLettersTests(SimpleTestCase):
+    def test_letters(self):
+        self.assertEqual(
+            [route_letters(i) for i in [0, 1, 25, 26, 27, 51, 52, 701, 702]],
+            ['A', 'B', 'Z', 'AA', 'AB', 'AZ', 'BA', 'ZZ', 'AAA'],
+        )
+
+
+class WireTests(SimpleTestCase):
+    def unpack(self, message):
+        return msgpack.unpackb(wire.encode(message))
+
+    def test_location(self):
+        message = {'type': 'location', 'latitude': 12.9716, 'longitude': 77.594566}
+        self.assertEqual(self.unpack(message), [wire.LOCATION, 12971600, 77594566])
+
+    def test_notification(self):
+        message = {'type': 'notification', 'title': 'Bus is ~200m away!', 'body': 'Get ready'}
+        self.assertEqual(self.unpack(message), [wire.NOTIFICATION, 'Bus is ~200m away!', 'Get ready'])
+
+    def test_student_check_in(self):
+        message = {'type': 'student_check_in', 'student_id': 7, 'is_boarding': False}
+        self.assertEqual(self.unpack(message), [wire.STUDENT_CHECK_IN, 7, False])
+
+    def test_error(self):
+        self.assertEqual(self.unpack({'type': 'error', 'message': 'Nope'}), [wire.ERROR, 'Nope'])
+
+    def test_batch(self):
+        message = {'type': 'batch', 'messages': [
+            {'type': 'location', 'latitude': 1.5, 'longitude': -2.25},
+            {'type': 'student_check_in', 'student_id': 3, 'is_boarding': True},
+        ]}
+        self.assertEqual(self.unpack(message), [
+            wire.BATCH, [[wire.LOCATION, 1500000, -2250000], [wire.STUDENT_CHECK_IN, 3, True]],
+        ])
+
+    def test_snapshot(self):
+        message = {
+            'type': 'snapshot',
+            'route_name': 'Route A',
+            'bus': {'latitude': 12.97, 'longitude': 77.59, 'last_seen': '2024-01-02T03:04:05.500000+00:00'},
+            'stops': [{
+                'id': 4, 'username': 'ana', 'address': 'MG Road', 'latitude': 12.98, 'longitude': 77.6,
+                'pickup_order': 1, 'driving_time_seconds': 300, 'is_boarding_today': True,
+            }],
+            'your_pickup_order': 1,
+            'eta_seconds': 240,
+        }
+        self.assertEqual(self.unpack(message), [
+            wire.SNAPSHOT, 'Route A',
+            [12970000, 77590000, 1704164645.5],
+            [[4, 12980000, 77600000, 1, True, 'ana', 'MG Road']],
+            1, 240,
+        ])
+
+    def test_snapshot_without_bus_or_stop_locations(self):
+        message = {
+            'type': 'snapshot',
+            'route_name': 'Route A',
+            'bus': None,
+            'stops': [{
+                'id': 4, 'username': 'ana', 'address': None, 'latitude': None, 'longitude': None,
+                'pickup_order': None, 'driving_time_seconds': None, 'is_boarding_today': False,
+            }],
+            'your_pickup_order': None,
+            'eta_seconds': None,
+        }
+        self.assertEqual(self.unpack(message), [
+            wire.SNAPSHOT, 'Route A', None, [[4, None, None, None, False, 'ana', None]], None, None,
+        ])
+
+    def test_unknown_message_type(self):
+        with self.assertRaises(ValueError):
+            wire.encode({'type': 'something_new'})
+
+    def test_driver_location_round_trip(self):
+        message = {'type': 'location', 'latitude': -33.868820, 'longitude': 151.209296}
+        decoded = wire.decode(wire.encode(message))
+        self.assertEqual(decoded['type'], 'location')
+        self.assertAlmostEqual(decoded['latitude'], message['latitude'], places=6)
+        self.assertAlmostEqual(decoded['longitude'], message['longitude'], places=6)
+
+    def test_malformed_driver_frames_are_rejected(self):
+        frames = [
+            b'',
+            b'\xc1',  # never used in msgpack
+            b'{"type": "location"}',
+            msgpack.packb({'type': 'location', 'latitude': 1, 'longitude': 2}),
+            msgpack.packb([wire.LOCATION, 1]),
+            msgpack.packb([wire.LOCATION, 1, 2, 3]),
+            msgpack.packb([wire.NOTIFICATION, 'title', 'body']),
+            msgpack.packb([wire.LOCATION, 'north', 'east']),
+            msgpack.packb([wire.LOCATION, 1.5, 2.5]),
+            msgpack.packb([wire.LOCATION, None, 2]),
+            msgpack.packb([wire.LOCATION, True, False]),
+        ]
+        for frame in frames:
+            with self.subTest(frame=frame), self.assertRaises(ValueError):
+                wire.decode(frame)
+
+
+def make_student(name, route=None, latitude=None, longitude=None, **fields):
+    """A StudentProfile (and its user) named `name`."""
+    user = User.objects.create(username=name)
+    return StudentProfile.objects.create(
+        user=user, student_id=name, route=route, latitude=latitude, longitude=longitude, **fields
+    )
+
+
+@override_settings(TRAVEL_TIME_PROVIDER='local')
+class OptimizeRoutesTests(TestCase):
+    def run_command(self, *args):
+        call_command('optimize_routes', *args, stdout=io.StringIO())
+
+    def test_students_without_a_location_stay_last(self):
+        route = Route.objects.create(name='Route A', capacity=5)
+        for order, (lon, lat) in enumerate(random_locs(3), start=1):
+            make_student(f"on{order}", route, lat, lon, pickup_order=order, driving_time_seconds=600)
+        unlocated = make_student('unlocated', route, pickup_order=2)
+        waiting = make_student('waiting', None, *reversed(random_locs(1, seed=1)[0]))
+
+        for args in [(), ('--full',)]:
+            with self.subTest(args=args):
+                self.run_command(*args)
+                unlocated.refresh_from_db()
+                waiting.refresh_from_db()
+                self.assertEqual(waiting.route, route)
+                self.assertIsNotNone(waiting.driving_time_seconds)
+                self.assertEqual(unlocated.route, route)
+                self.assertEqual(unlocated.pickup_order, 5)
+                self.assertIsNone(unlocated.driving_time_seconds)
+                self.assertEqual(
+                    sorted(route.students.values_list('pickup_order', flat=True)), [1, 2, 3, 4, 5]
+                )
+                # Waitlist the student again for the next run
+                StudentProfile.objects.filter(id=waiting.id).update(
+                    route=None, pickup_order=None, driving_time_seconds=None
+                )
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DriverApiTestCase(TestCase):
+    """A driver on 'Route A', logged in to self.client."""
+
+    def setUp(self):
+        cache.clear()
+        self.route = Route.objects.create(name='Route A')
+        self.driver = User.objects.create(username='driver')
+        DriverProfile.objects.create(user=self.driver, route_assigned=self.route, license_number='L1')
+        self.client = APIClient()
+        self.client.force_authenticate(self.driver)
+        # Write what the requests buffered before the test's transaction is rolled back
+        self.addCleanup(flush_history)
+        self.addCleanup(flush_locations)
+
+
+class UpdateBusLocationTests(DriverApiTestCase):
+    def ping(self, data):
+        return self.client.post('/api/transport/update-location/', data, format='json')
+
+    def test_valid_ping_becomes_the_live_position(self):
+        self.assertEqual(self.ping({'latitude': '12.97', 'longitude': 77.59}).status_code, 200)
+        live = get_live_location(self.route.id)
+        self.assertEqual((live['latitude'], live['longitude']), (12.97, 77.59))
+
+    def test_bad_coordinates_are_rejected(self):
+        for data in [
+            {},
+            {'latitude': 12.97},
+            {'latitude': 'abc', 'longitude': 'x'},
+            {'latitude': [1], 'longitude': 77.59},
+            {'latitude': 91, 'longitude': 77.59},
+            {'latitude': 12.97, 'longitude': -181},
+            {'latitude': 'nan', 'longitude': 77.59},
+        ]:
+            with self.subTest(data=data):
+                self.assertEqual(self.ping(data).status_code, 400)
+        self.assertIsNone(get_live_location(self.route.id))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class JobOutputTests(SimpleTestCase):
+    def test_live_log_is_saved_at_most_once_per_interval(self):
+        cache.clear()
+        output = jobs.JobOutput('job')
+        for number in range(200):
+            output.write(f"Planned new route {number}\n")
+        # Only the first write fell outside the interval
+        self.assertEqual(jobs.get_job_log(jobs.OptimizationJob(id='job', status='running')), "Planned new route 0\n")
+        output.save()
+        self.assertEqual(cache.get(jobs._live_log_key('job')), output.getvalue())
+        self.assertEqual(output.getvalue().count('\n'), 200)
+
+
+def chain_times(size):
+    """Driving times for stops 0..size-1 plus the college (index size): 60 s per index apart."""
+    index = np.arange(size + 1)
+    return np.abs(index[:, None] - index[None, :]) * 60.0
+
+
+class RoutePlanTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.route_a = Route.objects.create(name='Route A', capacity=5)
+        self.route_c = Route.objects.create(name='Route C', capacity=5)
+        self.kept = make_student('kept', self.route_a, pickup_order=1, driving_time_seconds=999)
+        self.untimed = make_student('untimed', self.route_a, pickup_order=2)
+        self.reordered = make_student('reordered', self.route_a, pickup_order=3, driving_time_seconds=999)
+        self.moved = make_student('moved', self.route_c, pickup_order=1, driving_time_seconds=999)
+        self.waiting = make_student('waiting')
+        self.current = {
+            self.kept.id: ('Route A', 1, 999),
+            self.untimed.id: ('Route A', 2, None),
+            self.reordered.id: ('Route A', 3, 999),
+            self.moved.id: ('Route C', 1, 999),
+            self.waiting.id: UNASSIGNED,
+        }
+
+        # Route A: kept, untimed, waiting, moved, reordered
+        self.plan = RoutePlan()
+        stops = [self.kept.id, self.untimed.id, self.reordered.id, self.moved.id, self.waiting.id]
+        self.plan.add_route('Route A', stops, chain_times(5), [0, 1, 4, 3, 2], 5, route_id=self.route_a.id)
+
+    def test_only_moved_or_untimed_rows_are_written(self):
+        self.assertEqual(self.plan.apply(self.current), 4)
+        rows = {
+            s.id: (s.route_id, s.pickup_order, s.driving_time_seconds) for s in StudentProfile.objects.all()
+        }
+        self.assertEqual(rows[self.kept.id], (self.route_a.id, 1, 999))  # not rewritten
+        self.assertEqual(rows[self.untimed.id], (self.route_a.id, 2, 240))
+        self.assertEqual(rows[self.waiting.id], (self.route_a.id, 3, 60))
+        self.assertEqual(rows[self.moved.id], (self.route_a.id, 4, 120))
+        self.assertEqual(rows[self.reordered.id], (self.route_a.id, 5, 180))
+
+    def test_unchanged_plan_writes_nothing(self):
+        plan = RoutePlan()
+        plan.add_route('Route C', [self.moved.id], chain_times(1), [0], 1, route_id=self.route_c.id)
+        self.assertEqual(plan.apply(self.current), 0)
+
+    def test_new_routes_get_ids_and_capacities(self):
+        plan = RoutePlan()
+        new = plan.add_route('Route B', [self.waiting.id], chain_times(1), [0], 1, capacity=40)
+        self.assertTrue(new.is_new)
+        plan.apply(self.current)
+
+        route = Route.objects.get(name='Route B')
+        self.assertEqual(new.route_id, route.id)
+        self.assertEqual(route.capacity, 40)
+        self.waiting.refresh_from_db()
+        self.assertEqual((self.waiting.route_id, self.waiting.pickup_order), (route.id, 1))
+
+    def test_diff(self):
+        labels = {student.id: student.student_id for student in StudentProfile.objects.all()}
+        self.assertEqual(self.plan.diff(self.current, labels), [
+            'Route A (existing): 5 stop(s), ~9 min',
+            '  + waiting at stop 3',
+            '  > moved from Route C stop 1 to stop 4',
+            '  ~ reordered stop 3 -> 5',
+        ])
+
+    def test_metrics(self):
+        metrics = self.plan.metrics(self.current)
+        self.assertEqual(
+            (metrics['routes'], metrics['new_routes'], metrics['stops'], metrics['newly_assigned'], metrics['reordered']),
+            (1, 0, 5, 1, 2),
+        )
+        self.assertEqual(metrics['total_seconds'], 540)
+
+
+@override_settings(TRAVEL_TIME_PROVIDER='local')
+class OptimizeRoutesDryRunTests(TestCase):
+    def test_dry_run_changes_nothing(self):
+        route = Route.objects.create(name='Route A', capacity=5)
+        for order, (lon, lat) in enumerate(random_locs(3), start=1):
+            make_student(f"on{order}", route, lat, lon, pickup_order=order)
+        for index, (lon, lat) in enumerate(random_locs(12, seed=1)):
+            make_student(f"waiting{index}", None, lat, lon)
+
+        def snapshot():
+            return (
+                list(Route.objects.order_by('id').values_list('id', 'name', 'capacity')),
+                list(StudentProfile.objects.order_by('id').values_list('id', 'route_id', 'pickup_order', 'driving_time_seconds')),
+            )
+
+        before = snapshot()
+        output = io.StringIO()
+        call_command('optimize_routes', '--dry-run', stdout=output)
+        self.assertIn('Dry run: no assignments were saved.', output.getvalue())
+        self.assertIn('  + waiting', output.getvalue())
+        self.assertEqual(snapshot(), before)
+
+
+class RecordingProvider(LocalMatrixProvider):
+    """The offline model, remembering what it was asked (or failing, like ORS down)."""
+    name = 'recording'
+
+    def __init__(self, fail=False):
+        super().__init__()
+        self.fail = fail
+        self.requests = []
+
+    def matrix(self, locations, sources=None, destinations=None):
+        self.requests.append((len(locations), sources, destinations))
+        if self.fail:
+            self.calls += 1
+            raise ConnectionError("ORS is down")
+        return super().matrix(locations, sources, destinations)
+
+
+class CachedMatrixProviderTests(TestCase):
+    def setUp(self):
+        self.locations = random_locs(4)
+        self.expected = LocalMatrixProvider().matrix(self.locations)['durations']
+        self.wrapped = RecordingProvider()
+        self.provider = CachedMatrixProvider(self.wrapped)
+
+    def test_second_request_comes_from_the_cache(self):
+        first = self.provider.matrix(self.locations)['durations']
+        second = self.provider.matrix(self.locations)['durations']
+        np.testing.assert_allclose(first, self.expected)
+        np.testing.assert_allclose(second, self.expected)
+        self.assertEqual(len(self.wrapped.requests), 1)
+        self.assertEqual((self.provider.hits, self.provider.misses), (16, 16))
+
+    def test_only_rows_and_columns_with_gaps_are_fetched(self):
+        # Everything between points 0 and 1 is known already
+        self.provider.matrix(self.locations[:2])
+        self.wrapped.requests.clear()
+
+        result = self.provider.matrix(self.locations, sources=[0, 2, 1], destinations=[1, 0])['durations']
+        np.testing.assert_allclose(result, self.expected[np.ix_([0, 2, 1], [1, 0])])
+        # Only point 2's row, against both destinations
+        self.assertEqual(self.wrapped.requests, [(3, [2], [1, 0])])
+        self.assertEqual(TravelTimeCache.objects.count(), 6)
+
+    def test_expired_entries_are_fetched_again(self):
+        self.provider.matrix(self.locations)
+        TravelTimeCache.objects.update(fetched_at=timezone.now() - timedelta(days=31))
+        with self.settings(TRAVEL_TIME_CACHE_TTL_DAYS=30):
+            self.provider.matrix(self.locations)
+        self.assertEqual(len(self.wrapped.requests), 2)
+        self.assertEqual(self.provider.hits, 0)
+
+    def test_pairs(self):
+        origins, destinations = self.locations[:2], self.locations[2:]
+        np.testing.assert_allclose(
+            self.provider.pairs(origins, destinations), [self.expected[0, 2], self.expected[1, 3]]
+        )
+        self.provider.pairs(origins, destinations)
+        self.assertEqual(len(self.wrapped.requests), 1)
+        self.assertEqual((self.provider.hits, self.provider.misses), (2, 2))
+
+    def test_failed_fetches_are_not_counted_as_fetched(self):
+        provider = CachedMatrixProvider(RecordingProvider(fail=True))
+        with self.assertRaises(ConnectionError):
+            provider.matrix(self.locations)
+        self.assertEqual((provider.hits, provider.misses, provider.calls), (0, 0, 1))
+
+        # The optimization run falls back to estimates and says so
+        table = DurationTable(provider, log=lambda line: None)
+        np.testing.assert_allclose(table.matrix(self.locations), self.expected)
+        self.assertTrue(table.failed)
+        self.assertEqual(TravelTimeCache.objects.count(), 0)
+
+    def test_prune_drops_expired_then_least_recently_used(self):
+        now = timezone.now()
+        keys = quantize(random_locs(6)).tolist()
+        TravelTimeCache.objects.bulk_create([TravelTimeCache(origin=key, destination=key, duration=60) for key in keys])
+        # Entry i was last used i minutes ago; entry 0 is recent but expired
+        for age, key in enumerate(keys):
+            TravelTimeCache.objects.filter(origin=key).update(
+                last_used=now - timedelta(minutes=age),
+                fetched_at=now - timedelta(days=40 if age == 0 else 1),
+            )
+        with self.settings(TRAVEL_TIME_CACHE_TTL_DAYS=30, TRAVEL_TIME_CACHE_MAX_ENTRIES=3):
+            prune_travel_time_cache()
+        self.assertEqual(sorted(TravelTimeCache.objects.values_list('origin', flat=True)), sorted(keys[1:4]))
+
+
+class ReportProviderUsageTests(SimpleTestCase):
+    def test_fallback_is_reported(self):
+        command = OptimizeRoutesCommand(stdout=io.StringIO())
+        command.provider = CachedMatrixProvider(RecordingProvider(fail=True))
+        command.table = DurationTable(command.provider, log=lambda line: None)
+        command.table.failed = True
+        command.report_provider_usage()
+        self.assertIn("0 fetched in 0 ORS call(s)", command.stdout.getvalue())
+        self.assertIn("offline estimates", command.stdout.getvalue())
+
+
+def point(seconds_ago, latitude=12.97, longitude=77.59, now=None):
+    """A batch point `seconds_ago` before now, timestamped like the browser does (ms)."""
+    now = now or timezone.now()
+    return {'latitude': latitude, 'longitude': longitude, 'timestamp': (now.timestamp() - seconds_ago) * 1000}
+
+
+class ParsePointsTests(SimpleTestCase):
+    def test_invalid_points_are_rejected_by_index(self):
+        now = timezone.now()
+        points = [
+            point(30, now=now),
+            {'latitude': 12.97, 'longitude': 77.59},  # no timestamp
+            point(20, latitude='north', now=now),
+            'junk',
+            point(10, latitude=95, now=now),
+            point(10, longitude=-181, now=now),
+            point(13 * 60 * 60, now=now),  # older than MAX_BATCH_AGE
+            point(-5 * 60, now=now),  # in the future
+            point(10, latitude='nan', now=now),
+            point(50, latitude=12.98, now=now),
+        ]
+        parsed, rejected = parse_points(points, now=now)
+        self.assertEqual(rejected, [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(len(parsed), 2)
+        # Sorted by time: the point sent last is the older one
+        np.testing.assert_allclose(parsed['t'], [now.timestamp() - 50, now.timestamp() - 30])
+        np.testing.assert_allclose(parsed['lat'], [12.98, 12.97], rtol=1e-6)
+
+    def test_slightly_fast_phone_clocks_are_accepted(self):
+        now = timezone.now()
+        parsed, rejected = parse_points([point(-30, now=now)], now=now)
+        self.assertEqual((len(parsed), rejected), (1, []))
+
+    def test_unusable_batches_raise(self):
+        for points in [None, {}, [], [point(1)] * (MAX_BATCH_POINTS + 1)]:
+            with self.subTest(count=len(points or [])), self.assertRaises(ValueError):
+                parse_points(points)
+
+
+class BatchUploadTests(DriverApiTestCase):
+    def upload(self, points):
+        return self.client.post('/api/transport/update-location/batch/', {'points': points}, format='json')
+
+    def stored_points(self):
+        flush_history()
+        return sum(LocationChunk.objects.filter(route=self.route).values_list('point_count', flat=True))
+
+    def test_fresh_newest_point_is_published(self):
+        res = self.upload([point(60, 12.96), point(5, 12.97), 'junk'])
+        self.assertEqual(res.data, {'accepted': 2, 'rejected': [2], 'published': True})
+        self.assertAlmostEqual(get_live_location(self.route.id)['latitude'], 12.97, places=5)
+        self.assertEqual(self.stored_points(), 2)
+
+    def test_stale_points_are_stored_but_not_published(self):
+        res = self.upload([point(60 * 60, 12.96), point(10 * 60, 12.97)])
+        self.assertEqual(res.data, {'accepted': 2, 'rejected': [], 'published': False})
+        self.assertIsNone(get_live_location(self.route.id))
+        self.assertEqual(self.stored_points(), 2)
+
+    def test_points_older_than_the_live_position_are_not_published(self):
+        self.client.post('/api/transport/update-location/', {'latitude': 12.99, 'longitude': 77.59}, format='json')
+        res = self.upload([point(30, 12.97)])
+        self.assertEqual(res.data, {'accepted': 1, 'rejected': [], 'published': False})
+        self.assertEqual(get_live_location(self.route.id)['latitude'], 12.99)
+        self.assertEqual(self.stored_points(), 2)
+
+    def test_batch_with_only_invalid_points(self):
+        res = self.upload([point(13 * 60 * 60), 'junk'])
+        self.assertEqual(res.data, {'accepted': 0, 'rejected': [0, 1], 'published': False})
+        self.assertEqual(self.stored_points(), 0)
+
+    def test_unusable_batch_is_a_400(self):
+        self.assertEqual(self.upload([]).status_code, 400)
+
+
+@override_settings(BROADCAST_MIN_SECONDS=2, BROADCAST_MAX_SECONDS=30, BROADCAST_MIN_DISTANCE_METERS=15)
+class ShouldBroadcastTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.start = timezone.now()
+
+    def check(self, seconds, meters, force=False):
+        """Whether a position `meters` north of the stop, `seconds` after the start, goes out."""
+        longitude, latitude = north_of_stop(meters)
+        return should_broadcast(1, latitude, longitude, self.start + timedelta(seconds=seconds), force=force)
+
+    def test_first_position_is_sent(self):
+        self.assertTrue(self.check(0, 0))
+
+    def test_positions_within_the_minimum_interval_are_suppressed(self):
+        self.check(0, 0)
+        self.assertFalse(self.check(1, 500))
+
+    def test_small_moves_are_suppressed(self):
+        self.check(0, 0)
+        self.assertFalse(self.check(5, 10))
+        self.assertTrue(self.check(6, 20))
+        # Measured from the last position sent, not the last one seen
+        self.assertFalse(self.check(9, 30))
+
+    def test_position_is_resent_after_the_maximum_interval(self):
+        self.check(0, 0)
+        self.assertFalse(self.check(29, 0))
+        self.assertTrue(self.check(30, 0))
+        self.assertFalse(self.check(31, 0))
+
+    def test_force_always_sends(self):
+        self.check(0, 0)
+        self.assertTrue(self.check(0.5, 1, force=True))
+        # and restarts the interval
+        self.assertFalse(self.check(1.5, 100))
+
+
+class GeofenceBroadcastTests(DriverApiTestCase):
+    def setUp(self):
+        super().setUp()
+        make_student('rider', self.route, STOP_LAT, STOP_LON, pickup_order=1, is_boarding_today=True)
+        self.layer = get_channel_layer()
+        self.channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(route_group_name(self.route.name), self.channel)
+
+    def received(self):
+        async def drain():
+            messages = []
+            while True:
+                try:
+                    messages.append(await asyncio.wait_for(self.layer.receive(self.channel), 0.05))
+                except asyncio.TimeoutError:
+                    return messages
+        return [message['type'] for message in async_to_sync(drain)()]
+
+    def publish(self, seconds, meters):
+        longitude, latitude = north_of_stop(meters)
+        publish_location(
+            get_driver_assignment(self.driver.id), latitude, longitude,
+            seen=self.start + timedelta(seconds=seconds)
+        )
+
+    def test_crossing_a_threshold_forces_a_broadcast(self):
+        self.start = timezone.now()
+        self.publish(0, 505)
+        self.assertEqual(self.received(), ['send_bus_location'])
+        # 10m further on and a second later: normally suppressed...
+        self.publish(1, 510)
+        self.assertEqual(self.received(), [])
+        # ...but crossing into the 500m zone sends the position with the notification
+        self.publish(1.5, 495)
+        self.assertEqual(self.received(), ['send_bus_location'])
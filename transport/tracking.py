@@ -0,0 +1,210 @@
+# transport/tracking.py
+"""
+What happens to a driver's location, wherever it comes from.
+
+    track_location(assignment, latitude, longitude, driver_name=...)
+
+adds a live ping (HTTP or WebSocket) to the GPS history and publishes
+it: caches it as the live position, sends any geofence notifications
+it triggers and broadcasts it to the route's map. A batch upload adds
+many points to the history (transport/history.py) but only calls
+publish_location() for the newest one.
+
+Broadcasts are throttled per route (see should_broadcast()), so a bus
+idling at the college doesn't wake every rider's phone each ping.
+
+parse_points() validates a batch of timestamped points from a driver
+that was offline for a while, and route_snapshot() is what a rider
+sees right after connecting, before the next ping arrives.
+"""
+from datetime import timedelta
+
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .geofence import notification_message
+from .history import POINT_DTYPE
+from .locations import append_history, get_live_location, record_location
+from .matrix import estimate_durations
+from .route_cache import get_route_fence, get_route_stops, notification_state
+from .utils import haversine
+
+MAX_BATCH_POINTS = 1000
+MAX_BATCH_AGE = timedelta(hours=12)  # older points are from another trip
+MAX_CLOCK_SKEW = timedelta(minutes=1)  # phones running slightly fast
+MAX_PUBLISH_AGE = timedelta(minutes=2)  # older points only go into the history
+BROADCAST_STATE_TIMEOUT = 60 * 60  # seconds
+
+
+def route_group_name(route_name):
+    """Everyone riding or driving a route: bus positions and admin broadcasts."""
+    return f"bus_route_{route_name.replace(' ', '_')}"
+
+
+def student_group_name(student_id):
+    """One student's connections: notifications meant only for them."""
+    return f"student_{student_id}"
+
+
+def _point_row(point):
+    """(timestamp, latitude, longitude) as floats, NaNs if the point is malformed."""
+    try:
+        return float(point['timestamp']), float(point['latitude']), float(point['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return np.nan, np.nan, np.nan
+
+
+def parse_points(points, now=None):
+    """
+    Checks a batch of {'latitude', 'longitude', 'timestamp'} dicts
+    (timestamp in Unix milliseconds, as the browser's geolocation API
+    gives it) all at once.
+
+    Returns (valid, rejected): the good points as a POINT_DTYPE array
+    sorted by time, and the indices of the points that were dropped
+    (malformed, out of range, older than MAX_BATCH_AGE or in the
+    future). Raises ValueError only if the batch itself is unusable.
+    """
+    if not isinstance(points, list) or not points:
+        raise ValueError("points must be a non-empty list.")
+    if len(points) > MAX_BATCH_POINTS:
+        raise ValueError(f"At most {MAX_BATCH_POINTS} points can be sent at once.")
+    rows = np.array([_point_row(point) for point in points], dtype=float)
+
+    now = (now or timezone.now()).timestamp()
+    seconds = rows[:, 0] / 1000
+    with np.errstate(invalid='ignore'):
+        bad = (
+            ~np.isfinite(rows).all(axis=1)
+            | (np.abs(rows[:, 1]) > 90) | (np.abs(rows[:, 2]) > 180)
+            | (seconds < now - MAX_BATCH_AGE.total_seconds())
+            | (seconds > now + MAX_CLOCK_SKEW.total_seconds())
+        )
+
+    good = ~bad
+    parsed = np.empty(int(good.sum()), dtype=POINT_DTYPE)
+    parsed['t'], parsed['lat'], parsed['lon'] = seconds[good], rows[good, 1], rows[good, 2]
+    parsed.sort(order='t', kind='stable')
+    return parsed, np.flatnonzero(bad).tolist()
+
+
+def route_snapshot(route_id, route_name, student_id=None):
+    """
+    Everything a map needs to draw a route at once: the last known bus
+    position (or None), the stops with their boarding flags and, for a
+    student, their pickup order and an ETA in seconds from the local
+    travel-time model. Served from the cache only.
+    """
+    stops = get_route_stops(route_id)
+    live = get_live_location(route_id)
+    my_stop = next((stop for stop in stops if stop['id'] == student_id), None)
+
+    eta_seconds = None
+    if live is not None and my_stop is not None and my_stop['latitude'] is not None:
+        eta_seconds = int(estimate_durations(
+            [live['longitude'], live['latitude']], [my_stop['longitude'], my_stop['latitude']]
+        )[0, 0])
+
+    return {
+        'type': 'snapshot',
+        'route_name': route_name,
+        'bus': None if live is None else {
+            'latitude': live['latitude'],
+            'longitude': live['longitude'],
+            'last_seen': live['last_seen'].isoformat(),
+        },
+        'stops': stops,
+        'your_pickup_order': my_stop and my_stop['pickup_order'],
+        'eta_seconds': eta_seconds,
+    }
+
+
+def track_location(assignment, latitude, longitude, driver_name=None):
+    """A live ping: appended to the GPS history, then published."""
+    seen = timezone.now()
+    # Written to the GPS history in the next batch
+    append_history(assignment['route_id'], [(seen, latitude, longitude)])
+    publish_location(assignment, latitude, longitude, driver_name=driver_name, seen=seen)
+
+
+def publish_location(assignment, latitude, longitude, driver_name=None, seen=None):
+    """
+    Makes (latitude, longitude) the bus's live position: caches it,
+    runs the geofence checks and broadcasts it to the route's group
+    (unless should_broadcast() says the bus has barely moved).
+    assignment is the dict from route_cache.get_driver_assignment().
+    Broadcast and geofence errors are logged, not raised.
+    """
+    route_id = assignment['route_id']
+    route_name = assignment['route_name']
+    channel_group_name = route_group_name(route_name)
+    seen = seen or timezone.now()
+
+    # Cached now, written to the database in the next batch
+    record_location(assignment, latitude, longitude, driver_name=driver_name, seen=seen)
+
+    # Geofence notifications, checked for every stop at once
+    notifications = []
+    try:
+        # Who was told what on this trip is kept in the cache, not on StudentProfile
+        fence = get_route_fence(route_id)
+        with notification_state(route_id) as notified:
+            notifications = fence.evaluate(longitude, latitude, notified)
+    except Exception as e:
+        print(f"Error in geofence logic: {e}")
+        import traceback
+        traceback.print_exc()
+
+    channel_layer = get_channel_layer()
+    try:
+        # WebSocket Broadcast (for live map), sent first so the map
+        # shows where the bus was when a notification arrives
+        if should_broadcast(route_id, latitude, longitude, seen, force=bool(notifications)):
+            async_to_sync(channel_layer.group_send)(
+                channel_group_name,
+                {
+                    'type': 'send_bus_location',
+                    'latitude': latitude,
+                    'longitude': longitude,
+                }
+            )
+
+        for notification in notifications:
+            print(
+                f"[Geofence] Sending {notification['threshold']}m notification "
+                f"to student {notification['student_id']} ({notification['distance']}m away)"
+            )
+            async_to_sync(channel_layer.group_send)(
+                student_group_name(notification['student_id']), notification_message(route_name, notification)
+            )
+    except Exception as e:
+        print(f"Error sending WebSocket broadcast: {e}")
+
+
+def should_broadcast(route_id, latitude, longitude, seen, force=False):
+    """
+    Decides whether a route's new position is worth sending to its
+    riders, and remembers it if so. A position goes out when:
+      - it is the first one (or the last broadcast has expired),
+      - force is set (a geofence threshold was crossed),
+      - BROADCAST_MAX_SECONDS passed since the last broadcast, or
+      - the bus moved BROADCAST_MIN_DISTANCE_METERS and at least
+        BROADCAST_MIN_SECONDS passed.
+    """
+    key = f"broadcast_state:{route_id}"
+    now = seen.timestamp()
+    last = cache.get(key)  # (latitude, longitude, unix time)
+    if last is not None and not force:
+        elapsed = now - last[2]
+        if elapsed < settings.BROADCAST_MAX_SECONDS:
+            if elapsed < settings.BROADCAST_MIN_SECONDS:
+                return False
+            moved = haversine(float(longitude), float(latitude), last[1], last[0]) * 1000
+            if moved < settings.BROADCAST_MIN_DISTANCE_METERS:
+                return False
+    cache.set(key, (float(latitude), float(longitude), now), BROADCAST_STATE_TIMEOUT)
+    return True
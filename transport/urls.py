@@ -7,12 +7,15 @@ urlpatterns = [
     # This maps the URL .../my-route/ to our my_route_view
     path('my-route/', views.my_route_view, name='my-route'),
     path('update-location/', views.update_bus_location, name='update-location'),
+    path('update-location/batch/', views.update_bus_location_batch, name='update-location-batch'),
     path('admin-broadcast/', views.admin_broadcast_view, name='admin-broadcast'),
     path('driver/my-route/', views.driver_route_view, name='driver-route'),
     path('driver/reorder-stops/', views.driver_reorder_view, name='driver-reorder'),
     path('route-geometry/', views.get_route_geometry_view, name='route-geometry'),
     path('test/', views.test_view, name='test-transport'),
     path('admin/trigger-optimization/', views.trigger_optimization_view, name='admin-trigger-optimization'),
+    path('admin/optimization-jobs/<uuid:job_id>/', views.optimization_job_view, name='admin-optimization-job'),
     path('admin/route/<int:route_id>/bus-location/', views.get_bus_location_view, name='admin-get-bus-location'),
+    path('admin/route/<int:route_id>/trace/', views.route_trace_view, name='admin-route-trace'),
     # path('reset-notification-status/', views.reset_notification_status_view, name='reset-notification-status'),
 ]
\ No newline at end of file
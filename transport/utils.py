@@ -1,4 +1,5 @@
 from math import radians, cos, sin, asin, sqrt
+import numpy as np
 
 def haversine(lon1, lat1, lon2, lat2):
     """
@@ -14,4 +15,37 @@ def haversine(lon1, lat1, lon2, lat2):
     a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
     c = 2 * asin(sqrt(a)) 
     r = 6371 # Radius of earth in kilometers.
-    return c * r
\ No newline at end of file
+    return c * r
+
+def haversine_matrix(lons1, lats1, lons2, lats2):
+    """
+    Batched version of haversine().
+    Takes two sets of points as arrays and returns a
+    len(set 1) x len(set 2) matrix of distances in kilometers.
+    """
+    lons1, lats1, lons2, lats2 = (
+        np.radians(np.asarray(values, dtype=float))
+        for values in (lons1, lats1, lons2, lats2)
+    )
+    lons1, lats1 = lons1[:, None], lats1[:, None]
+    lons2, lats2 = lons2[None, :], lats2[None, :]
+
+    dlon = lons2 - lons1
+    dlat = lats2 - lats1
+    a = np.sin(dlat/2)**2 + np.cos(lats1) * np.cos(lats2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    r = 6371 # Radius of earth in kilometers.
+    return c * r
+
+
+def route_letters(index):
+    """
+    Spreadsheet-style letters for a 0-based index:
+    0 -> 'A', 25 -> 'Z', 26 -> 'AA', 27 -> 'AB', ...
+    """
+    letters = ''
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
@@ -1,26 +1,32 @@
 import requests
-from io import StringIO
 import json
 from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
-from django.core.management import call_command
 from django.shortcuts import render
+from django.urls import reverse
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.authentication import SessionAuthentication
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
 # Import all your models and helpers
-from .models import Route
+from .models import Route, OptimizationJob
 from students.models import StudentProfile
 from drivers.models import DriverProfile 
 from .serializers import RouteStopSerializer
 from .permissions import IsDriver, IsAdminUser
-from .utils import haversine
+from .route_cache import get_driver_assignment, notification_state
+from .authentication import CachedJWTAuthentication
+from .locations import append_history, get_live_location
+from .tracking import MAX_PUBLISH_AGE, parse_points, publish_location, route_group_name, track_location
+from .history import get_trace, to_datetime, DEFAULT_TRACE_POINTS
+from django.utils.dateparse import parse_date
+from .jobs import fail_if_orphaned, submit_optimization, serialize_job
 
 # --- Helper Function ---
 def _get_address_from_coords(lat, lon):
@@ -56,9 +62,9 @@ def my_route_view(request):
             route__isnull=True, 
             latitude__isnull=False
         ).count()
-        bus_capacity = settings.BUS_CAPACITY
+        smallest_vehicle = min(settings.VEHICLE_FLEET)
         return Response(
-            {'message': f'You are on the waitlist. {waitlist_count} student(s) are waiting for a new route (need {bus_capacity}).'},
+            {'message': f'You are on the waitlist. {waitlist_count} student(s) are waiting for a new route (need {smallest_vehicle}).'},
             status=status.HTTP_404_NOT_FOUND
         )
     
@@ -82,9 +88,10 @@ def reset_notification_status_view(request):
     """
     try:
         student_profile = request.user.studentprofile
-        # Reset the last notified distance to None
-        student_profile.last_notification_distance = None
-        student_profile.save(update_fields=['last_notification_distance'])
+        # Forget what this trip already told them (the state lives in the cache)
+        if student_profile.route_id is not None:
+            with notification_state(student_profile.route_id) as notified:
+                notified.pop(student_profile.id, None)
         return Response(
             {'message': 'Notification status reset successfully.'},
             status=status.HTTP_200_OK
@@ -97,142 +104,83 @@ def reset_notification_status_view(request):
 
 # --- Driver Views ---
 @api_view(['POST'])
+@authentication_classes([CachedJWTAuthentication, SessionAuthentication])
 @permission_classes([IsAuthenticated, IsDriver])
 def update_bus_location(request):
     """
     API endpoint for the 'Driver App' to post the bus's
     current location. Includes Geofence Notifications.
+    The driver's route and its stops come from the cache
+    (transport/route_cache.py), so a ping does not read the database.
     """
     latitude = request.data.get('latitude')
     longitude = request.data.get('longitude')
-    if not latitude or not longitude:
+    if latitude in (None, '') or longitude in (None, ''):
         return Response({'error': 'Latitude and longitude are required.'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        return Response({'error': 'Latitude and longitude must be numbers.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not (abs(latitude) <= 90 and abs(longitude) <= 180):
+        return Response({'error': 'Latitude or longitude out of range.'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        driver_profile = request.user.driverprofile
-        current_route = driver_profile.route_assigned
-        if current_route is None:
+        assignment = get_driver_assignment(request.user.id)
+        if assignment['route_id'] is None:
             raise AttributeError("Driver is not assigned to a route.")
-
-        driver_profile.last_latitude = latitude
-        driver_profile.last_longitude = longitude
-        driver_profile.last_seen = timezone.now()
-        driver_profile.save()
-
-        route_name = current_route.name
-        channel_group_name = f"bus_route_{route_name.replace(' ', '_')}"
     except AttributeError as e:
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         print(f"Error in update_bus_location (Profile section): {e}")
         return Response({'error': 'An internal error occurred.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    # 4. WebSocket Broadcast (for live map)
-    try:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            channel_group_name,
-            {
-                'type': 'send_bus_location',
-                'latitude': latitude,
-                'longitude': longitude,
-            }
-        )
-    except Exception as e:
-        print(f"Error sending WebSocket broadcast: {e}")
+    # GPS history, live position, WebSocket broadcast and geofence notifications
+    track_location(assignment, latitude, longitude, driver_name=request.user.username)
+
+    return Response(status=status.HTTP_200_OK)
 
-    # 5. IMPROVED Geofence Notification Logic with per-student targeting
+@api_view(['POST'])
+@authentication_classes([CachedJWTAuthentication, SessionAuthentication])
+@permission_classes([IsAuthenticated, IsDriver])
+def update_bus_location_batch(request):
+    """
+    API endpoint for the 'Driver App' to upload the points it
+    buffered while offline, in one request:
+    {"points": [{"latitude", "longitude", "timestamp"}, ...]}
+    with timestamp in Unix milliseconds. Every valid point goes into
+    the GPS history; invalid ones are dropped and their indices
+    returned as "rejected". Only the newest point moves the live bus
+    and is checked against the geofences, and only if it is recent
+    (MAX_PUBLISH_AGE) and newer than the live position we already have.
+    """
     try:
-        # Define the notification thresholds in meters (sorted descending)
-        # FINAL threshold is 30 meters - only sent once as the "last call"
-        NOTIFICATION_DISTANCES = [500, 400, 300, 200, 100, 30]
-        FINAL_THRESHOLD = 30  # Special handling for the final notification
-        
-        students_on_route = current_route.students.filter(is_boarding_today=True)
-        
-        for student in students_on_route:
-            if not student.latitude or not student.longitude:
-                continue
-                
-            distance_km = haversine(
-                longitude, latitude,
-                student.longitude, student.latitude
-            )
-            distance_meters = int(distance_km * 1000)
-            
-            print(f"[Geofence] Distance to {student.user.username}: {distance_meters}m (Last notified: {student.last_notification_distance})")
-
-            # Find which threshold we're currently inside (the most specific one)
-            current_threshold = None
-            for threshold in NOTIFICATION_DISTANCES:
-                if distance_meters <= threshold:
-                    current_threshold = threshold
-                    # We do NOT break, so it finds the smallest threshold
-            
-            # If we're outside all thresholds (> 500m), reset tracking
-            if current_threshold is None:
-                if student.last_notification_distance is not None:
-                    student.last_notification_distance = None
-                    student.save(update_fields=['last_notification_distance'])
-                    print(f"[Geofence] Bus left 500m zone for {student.user.username}. Reset.")
-                continue
-            
-            # Special handling for the 30m final notification
-            # Only send it ONCE when we first enter the 30m zone
-            if current_threshold <= FINAL_THRESHOLD:
-                # Only send if we haven't already sent the 30m notification
-                if student.last_notification_distance != FINAL_THRESHOLD:
-                    print(f"[Geofence] 🚨 FINAL NOTIFICATION - Sending {current_threshold}m alert to {student.user.username}")
-                    
-                    async_to_sync(channel_layer.group_send)(
-                        channel_group_name,
-                        {
-                            'type': 'send_arrival_notification',
-                            'title': f"🚨 Bus is HERE! ({distance_meters}m)",
-                            'body': f"FINAL CALL! The bus for {route_name} is at your stop. Please be ready!",
-                            'target_student_id': student.id
-                        }
-                    )
-                    
-                    student.last_notification_distance = FINAL_THRESHOLD
-                    student.save(update_fields=['last_notification_distance'])
-                    print(f"[Geofence] ✅ FINAL notification sent. No more will be sent until reset.")
-                else:
-                    print(f"[Geofence] Already sent 30m final notification to {student.user.username}. Skipping.")
-                
-                continue  # Skip regular logic for 30m zone
-            
-            # Regular threshold logic (for 500m, 400m, 300m, 200m, 100m)
-            # We send if: (1) never sent before OR (2) crossed into a smaller threshold
-            should_send = (
-                student.last_notification_distance is None or 
-                current_threshold < student.last_notification_distance
-            )
-            
-            if should_send:
-                print(f"[Geofence] ✉️ Sending {current_threshold}m notification to {student.user.username}")
-                
-                async_to_sync(channel_layer.group_send)(
-                    channel_group_name,
-                    {
-                        'type': 'send_arrival_notification',
-                        'title': f"Bus is ~{current_threshold}m away!",
-                        'body': f"The bus for {route_name} is approaching your stop. Current distance: {distance_meters}m",
-                        'target_student_id': student.id
-                    }
-                )
-                
-                # Update the database with the new threshold
-                student.last_notification_distance = current_threshold
-                student.save(update_fields=['last_notification_distance'])
-                print(f"[Geofence] ✅ Notification sent and saved for {current_threshold}m threshold")
+        points, rejected = parse_points(request.data.get('points'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-    except Exception as e:
-        print(f"Error in geofence logic: {e}")
-        import traceback
-        traceback.print_exc()
+    assignment = get_driver_assignment(request.user.id)
+    if assignment['route_id'] is None:
+        return Response({'error': 'Driver is not assigned to a route.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    return Response(status=status.HTTP_200_OK)
+    published = False
+    if len(points):
+        append_history(assignment['route_id'], points.tolist())
+
+        newest = points[-1]
+        seen = to_datetime(newest['t'])
+        live = get_live_location(assignment['route_id'])
+        published = timezone.now() - seen <= MAX_PUBLISH_AGE and (live is None or live['last_seen'] < seen)
+        if published:
+            publish_location(
+                assignment, float(newest['lat']), float(newest['lon']),
+                driver_name=request.user.username, seen=seen
+            )
+
+    return Response(
+        {'accepted': len(points), 'rejected': rejected, 'published': published},
+        status=status.HTTP_200_OK
+    )
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsDriver])
@@ -318,7 +266,7 @@ def admin_broadcast_view(request):
 
     try:
         channel_layer = get_channel_layer()
-        channel_group_name = f"bus_route_{route.name.replace(' ', '_')}"
+        channel_group_name = route_group_name(route.name)
         print(f"Admin broadcasting to {channel_group_name}...")
         
         async_to_sync(channel_layer.group_send)(
@@ -342,21 +290,36 @@ def admin_broadcast_view(request):
 def trigger_optimization_view(request):
     """
     API endpoint for an Admin to trigger the optimize_routes command.
+    The command runs in the background; poll the returned status_url
+    (or listen on the WebSocket) for progress.
     """
     try:
         print("Admin triggered route optimization.")
-        out = StringIO()
-        call_command('optimize_routes', stdout=out)
-        output = out.getvalue()
+        job = submit_optimization(user=request.user)
         return Response({
-            "message": "Optimization command executed.",
-            "output": output
-        }, status=status.HTTP_200_OK)
+            "message": "Optimization started.",
+            "job_id": str(job.id),
+            "status": job.status,
+            "status_url": reverse('admin-optimization-job', args=[job.id]),
+            "websocket_path": f"/ws/optimization/{job.id}/",
+        }, status=status.HTTP_202_ACCEPTED)
     except Exception as e:
         return Response({
-            "message": "Error running optimization command.",
+            "message": "Error starting optimization.",
             "error": str(e)
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def optimization_job_view(request, job_id):
+    """
+    API endpoint for an Admin to poll a background optimization job.
+    """
+    try:
+        job = OptimizationJob.objects.get(id=job_id)
+    except OptimizationJob.DoesNotExist:
+        return Response({'error': 'Optimization job not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(serialize_job(fail_if_orphaned(job)), status=status.HTTP_200_OK)
     
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsAdminUser])
@@ -364,7 +327,18 @@ def get_bus_location_view(request, route_id):
     """
     API endpoint for an Admin to get the last known location
     of the driver assigned to a specific route.
+    Live positions come from the cache; the database copy
+    is only used when the cache has none.
     """
+    live = get_live_location(route_id)
+    if live is not None:
+        return Response({
+            'latitude': live['latitude'],
+            'longitude': live['longitude'],
+            'last_seen': live['last_seen'],
+            'driver_name': live['driver_name']
+        }, status=status.HTTP_200_OK)
+
     try:
         driver = DriverProfile.objects.get(route_assigned__id=route_id)
         if driver.last_latitude is None:
@@ -378,6 +352,37 @@ def get_bus_location_view(request, route_id):
     except DriverProfile.DoesNotExist:
         return Response({'error': 'No driver is assigned to this route.'}, status=status.HTTP_404_NOT_FOUND)
 
+MAX_TRACE_POINTS = 5000
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def route_trace_view(request, route_id):
+    """
+    API endpoint for an Admin to get the path a route's bus drove
+    on one day, as a downsampled polyline.
+    ?date=YYYY-MM-DD (default today), ?max_points=N (default 500)
+    """
+    try:
+        date_param = request.query_params.get('date')
+        day = parse_date(date_param) if date_param else timezone.localdate()
+        if day is None:
+            raise ValueError
+        max_points = int(request.query_params.get('max_points', DEFAULT_TRACE_POINTS))
+    except ValueError:
+        return Response(
+            {'error': 'date must be YYYY-MM-DD and max_points a number.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    max_points = min(max(max_points, 2), MAX_TRACE_POINTS)
+
+    points = get_trace(route_id, day, max_points)
+    return Response({
+        'route_id': route_id,
+        'date': day.isoformat(),
+        'coordinates': [[float(lat), float(lon)] for lat, lon in zip(points['lat'], points['lon'])],
+        'timestamps': [to_datetime(t).isoformat() for t in points['t']],
+    }, status=status.HTTP_200_OK)
+
 # --- Geometry and Test Views ---
 ORS_DIRECTIONS_ENDPOINT = 'https://api.openrouteservice.org/v2/directions/driving-car/geojson'
 
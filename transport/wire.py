@@ -0,0 +1,99 @@
+# transport/wire.py
+"""
+Compact binary frames for the bus tracking socket (ws/track/).
+
+JSON stays the default. A client that asks for the MSGPACK_SUBPROTOCOL
+subprotocol when it connects gets every message as one msgpack array
+in a binary frame instead: an integer type tag first, then the fields
+in a fixed order, with coordinates as integers in millionths of a
+degree (about 11 cm):
+
+    location          [1, lat, lon]
+    notification      [2, title, body]
+    student_check_in  [3, student_id, is_boarding]
+    snapshot          [4, route_name, bus, stops, your_pickup_order, eta_seconds]
+                        bus:  [lat, lon, last_seen (Unix seconds)] or nil
+                        stop: [id, lat, lon, pickup_order, is_boarding_today, username, address]
+    batch             [5, [message, ...]]
+    error             [6, message]
+
+Drivers send their location the same way: [1, lat, lon]. The student
+app's decoder is student-app/src/wire.js.
+"""
+from datetime import datetime
+
+import msgpack
+
+MSGPACK_SUBPROTOCOL = 'bus.msgpack.v1'
+COORDINATE_SCALE = 10 ** 6
+
+LOCATION = 1
+NOTIFICATION = 2
+STUDENT_CHECK_IN = 3
+SNAPSHOT = 4
+BATCH = 5
+ERROR = 6
+
+
+def _fixed(degrees):
+    return None if degrees is None else round(float(degrees) * COORDINATE_SCALE)
+
+
+def _degrees(fixed):
+    return fixed / COORDINATE_SCALE
+
+
+def _compact(message):
+    kind = message['type']
+    if kind == 'location':
+        return [LOCATION, _fixed(message['latitude']), _fixed(message['longitude'])]
+    if kind == 'notification':
+        return [NOTIFICATION, message['title'], message['body']]
+    if kind == 'student_check_in':
+        return [STUDENT_CHECK_IN, message['student_id'], message['is_boarding']]
+    if kind == 'snapshot':
+        bus = message['bus']
+        return [
+            SNAPSHOT,
+            message['route_name'],
+            bus and [
+                _fixed(bus['latitude']), _fixed(bus['longitude']),
+                datetime.fromisoformat(bus['last_seen']).timestamp(),
+            ],
+            [
+                [
+                    stop['id'], _fixed(stop['latitude']), _fixed(stop['longitude']),
+                    stop['pickup_order'], stop['is_boarding_today'], stop['username'], stop['address'],
+                ]
+                for stop in message['stops']
+            ],
+            message['your_pickup_order'],
+            message['eta_seconds'],
+        ]
+    if kind == 'batch':
+        return [BATCH, [_compact(queued) for queued in message['messages']]]
+    if kind == 'error':
+        return [ERROR, message['message']]
+    raise ValueError(f"No binary encoding for message type: {kind}")
+
+
+def encode(message):
+    """A BusConsumer message dict as a msgpack frame."""
+    return msgpack.packb(_compact(message))
+
+
+def decode(data):
+    """
+    A frame from a driver as the message dict BusConsumer.receive
+    expects. Raises ValueError for anything but a location.
+    """
+    try:
+        frame = msgpack.unpackb(data)
+    except Exception:
+        raise ValueError("Not a msgpack frame.")
+    if (
+        not isinstance(frame, list) or len(frame) != 3 or frame[0] != LOCATION
+        or not all(isinstance(value, int) and not isinstance(value, bool) for value in frame[1:])
+    ):
+        raise ValueError("Expected [1, latitude, longitude].")
+    return {'type': 'location', 'latitude': _degrees(frame[1]), 'longitude': _degrees(frame[2])}
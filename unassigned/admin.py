@@ -2,9 +2,9 @@
 from django.contrib import admin
 from django.urls import path, reverse
 from django.http import HttpResponseRedirect
-from django.core.management import call_command
 from django.contrib import messages
-from io import StringIO
+from transport.jobs import submit_optimization
+from transport.models import OptimizationJob
 from .models import UnassignedStudent
 
 @admin.register(UnassignedStudent)
@@ -39,7 +39,16 @@ class UnassignedStudentAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return False
 
-    # 6. Add our custom "Optimize Routes" button
+    # 6. Show the latest optimization job above the list
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        job = OptimizationJob.objects.first()
+        if job:
+            extra_context['latest_job'] = job
+            extra_context['latest_job_status_url'] = reverse('admin-optimization-job', args=[job.id])
+        return super().changelist_view(request, extra_context=extra_context)
+
+    # 7. Add our custom "Optimize Routes" button
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
@@ -51,15 +60,14 @@ class UnassignedStudentAdmin(admin.ModelAdmin):
         ]
         return custom_urls + urls
 
-    # 7. This view runs when the button is pressed
+    # 8. This view runs when the button is pressed.
+    # The command runs in the background; the list page shows its progress.
     def trigger_optimization_view(self, request):
         try:
-            out = StringIO() # Capture the output
-            call_command('optimize_routes', stdout=out)
-            # Show the script's output as a success message
-            messages.success(request, out.getvalue())
+            job = submit_optimization(user=request.user)
+            messages.success(request, f"Route optimization started (job {job.id}).")
         except Exception as e:
-            messages.error(request, f"Error running optimization: {e}")
+            messages.error(request, f"Error starting optimization: {e}")
 
         # Redirect back to the list page
         return HttpResponseRedirect(reverse('admin:unassigned_unassignedstudent_changelist'))
\ No newline at end of file